@@ -29,6 +29,10 @@ from operations import rethink
 r2e.make(skip_lexique=True)
 # r2e.make(only_xls=True)
 
+# Keep the search index updated, forever
+# from operations import sync
+# sync.run()
+
 #########################
 print("Conversion completed")
 exit(0)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Remember what was already seen, without keeping it.
+
+Values are reduced to small digests: a set of digests is exact
+(up to hash collisions), a Bloom filter has a fixed size
+and a configurable rate of false positives.
+"""
+
+import os
+import math
+import hashlib
+
+# 'set' or 'bloom'
+DEDUP_MODE = os.environ.get('DEDUP_MODE', 'set')
+# Bloom filter: expected values and false positives rate
+DEDUP_CAPACITY = int(os.environ.get('DEDUP_CAPACITY', 1000000))
+DEDUP_ERROR_RATE = float(os.environ.get('DEDUP_ERROR_RATE', 0.001))
+DIGEST_SIZE = 8
+
+
+def digest(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return hashlib.blake2b(value, digest_size=DIGEST_SIZE).digest()
+
+
+class DigestSet(object):
+    """ Exact (collisions apart), 8 bytes of digest for each value """
+
+    def __init__(self):
+        super(DigestSet, self).__init__()
+        self._digests = set()
+
+    def __contains__(self, value):
+        return digest(value) in self._digests
+
+    def __len__(self):
+        return len(self._digests)
+
+    def add(self, value):
+        """ True if the value is new """
+        key = digest(value)
+        if key in self._digests:
+            return False
+        self._digests.add(key)
+        return True
+
+
+class BloomFilter(object):
+    """ Fixed memory: some new values may look already seen """
+
+    def __init__(self, capacity=DEDUP_CAPACITY, error_rate=DEDUP_ERROR_RATE):
+        super(BloomFilter, self).__init__()
+        bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.size = max(8, int(math.ceil(bits)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+        self._count = 0
+
+    def _positions(self, value):
+        # Double hashing: k positions from two 64 bits halves
+        raw = hashlib.blake2b(
+            value if isinstance(value, bytes) else value.encode('utf-8'),
+            digest_size=16).digest()
+        first = int.from_bytes(raw[:8], 'little')
+        second = int.from_bytes(raw[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+    def __len__(self):
+        return self._count
+
+    def add(self, value):
+        """ True if the value is (surely) new """
+        new = False
+        for position in self._positions(value):
+            mask = 1 << (position & 7)
+            if not self._bits[position >> 3] & mask:
+                self._bits[position >> 3] |= mask
+                new = True
+        if new:
+            self._count += 1
+        return new
+
+
+def new_dedup(mode=DEDUP_MODE):
+    if mode == 'bloom':
+        return BloomFilter()
+    return DigestSet()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Where each search field lives inside the 'steps' of a datavalues record.
+
+The mapping is declared once, as (step, position) -> field,
+and compiled into dictionaries used by the indexer
+and by the maintenance scripts.
+"""
+
+# Position holding the main value of a step
+MAIN_POSITION = 1
+# Fields used to compute the dates, not saved as they are
+DATE = 'date'
+
+
+def to_gravure(value):
+    return 'gravure' in value.lower()
+
+
+# (step, position, field, converter)
+# a field named 'date.<name>' is a part of the date
+FIELDS_MAPPING = [
+    (1, 1, 'extrait', None),
+    (1, 2, 'page', None),
+    (1, 3, 'gravure', to_gravure),
+    (2, 1, 'source', None),
+    (2, 2, 'manuscrit', None),
+    (3, 1, 'fete', None),
+    (3, 4, 'date.year', int),
+    (3, 5, 'lieu', None),
+    (3, 8, 'date.start', None),
+    (3, 9, 'date.end', None),
+    (4, 3, 'temps', None),
+    (4, 4, 'actions', None),
+    (4, 6, 'apparato', None),
+]
+
+
+def compile_mapping(mapping=FIELDS_MAPPING):
+    """
+    Three dictionaries:
+    extra fields by (step, position), with their group and converter;
+    main fields by step; (step, position) by field.
+    """
+    extra = {}
+    main = {}
+    positions = {}
+    for step, position, field, converter in mapping:
+        positions[field] = (step, position)
+        if position == MAIN_POSITION:
+            main[step] = field
+            continue
+        group = None
+        if field.startswith(DATE + '.'):
+            group, field = field.split('.', 1)
+        extra[(step, position)] = (group, field, converter)
+    return extra, main, positions
+
+
+EXTRA_FIELDS, MAIN_FIELDS, FIELD_POSITIONS = compile_mapping()
+
+
+def get_element(doc, field):
+    """ The element of the record holding a field, if any """
+    step_number, position = FIELD_POSITIONS[field]
+    for step in doc['steps']:
+        if int(step['step']) != step_number:
+            continue
+        for element in step['data']:
+            if element['position'] == position:
+                return element
+    return None
+
+
+def get_value(doc, field):
+    element = get_element(doc, field)
+    if element is None:
+        return None
+    return element.get('value')
+
+
+def set_value(doc, field, value):
+    """ False if the record has no element for the field """
+    element = get_element(doc, field)
+    if element is None:
+        return False
+    element['value'] = value
+    return True
@@ -15,7 +15,8 @@ keys = ['sheet', 'macro', 'micro', 'titre', 'latin', 'italien', 'français']
 class GExReader(object):
     """ Reading google spreadsheets online """
 
-    def __init__(self, filename=None, rethink=None, elastic=None):
+    def __init__(self, filename=None, rethink=None, elastic=None,
+                 index=EL_INDEX3):
 
         if filename is None:
             filename = "/uploads/data/test2.xlsx"
@@ -38,6 +39,7 @@ class GExReader(object):
             self._el = elastic
         else:
             self._el = None
+        self._index = index
 
         # CONNECT
         filename = 'Voc typol_CH_Rd'
@@ -82,7 +84,7 @@ class GExReader(object):
             self._r.insert(term).run()
             # Update elastic specific index
             self._el.index(
-                index=EL_INDEX3, id=row_num, body=term, doc_type=EL_TYPE1)
+                index=self._index, id=row_num, body=term, doc_type=EL_TYPE1)
 
             # print(term)
             # return False
@@ -1,16 +1,43 @@
 # -*- coding: utf-8 -*-
 
+import re
+from html import unescape
 import lxml.html
 import lxml.etree
 
+TAGS_PATTERN = re.compile(r'<[^>]*>')
+# Word boundaries of the ES 'standard' tokenizer, roughly:
+# letters joined by apostrophes or dots, digits joined by dots or commas
+WORDS_PATTERN = re.compile(
+    r"\w+(?:(?:(?<=[^\W\d])['\u2019.:](?=[^\W\d])|(?<=\d)[.,](?=\d))\w+)*")
+
 
 def convert(html_text):
     try:
         document = lxml.html.document_fromstring(html_text)
-    except (lxml.etree.ParserError, lxml.etree.XMLSyntaxError, ValueError) as e:
+    except (lxml.etree.ParserError,
+            lxml.etree.XMLSyntaxError, ValueError) as e:
         # empty document
         return ''
 
     raw_text = document.text_content()
     return raw_text
 
+
+def tokenize(html_text):
+    """
+    Same tokens of an 'html_strip' char filter + 'standard' tokenizer,
+    without asking Elasticsearch to analyze the text.
+    """
+    text = unescape(TAGS_PATTERN.sub(' ', html_text))
+    tokens = []
+    for position, match in enumerate(WORDS_PATTERN.finditer(text)):
+        token = match.group(0)
+        tokens.append({
+            'token': token,
+            'start_offset': match.start(),
+            'end_offset': match.end(),
+            'type': '<NUM>' if token[0].isdigit() else '<ALPHANUM>',
+            'position': position,
+        })
+    return tokens
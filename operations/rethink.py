@@ -13,12 +13,15 @@ a = v.table('datadocs').update({"type":'documents'}).run()
 
 from __future__ import absolute_import
 import os
+import time
 import shutil
 import glob
-from restapi.resources.services.rethink import RethinkConnection, RDBquery
+from restapi.resources.services.rethink import RethinkConnection, RDBquery, \
+    LOGS_COLUMN, TIME_COLUMN, ACTION_COLUMN
 from restapi.resources.services.uploader import ZoomEnabling
 from restapi.resources.utilities import split_and_html_strip
 from restapi.resources.custom.docs import image_destination
+from operations.fields import get_value, set_value
 from restapi import get_logger
 from rethinkdb import r
 from rethinkdb.net import DefaultCursorEmpty
@@ -114,12 +117,7 @@ def find_double_records():
     elements = {}
     for element in table.run():
 
-        extrait = None
-        for step in element['steps']:
-            if step['step'] == 1:
-                for piece in step['data']:
-                    if piece['position'] == 1:
-                        extrait = piece['value']
+        extrait = get_value(element, 'extrait')
 
         if extrait not in elements:
             elements[extrait] = []
@@ -158,12 +156,9 @@ def fix_sources():
     data = list(table.run())
 
     for element in data:
-        extrait = None
-        source = None
-        try:
-            extrait = element['steps'][0]['data'][0]['value']
-            source = element['steps'][1]['data'][0]['value']
-        except:
+        extrait = get_value(element, 'extrait')
+        source = get_value(element, 'source')
+        if extrait is None or source is None:
             continue
 
         for key, (right, wrong) in fixable.items():
@@ -172,7 +167,10 @@ def fix_sources():
                 # print("TEST", key, extrait, source)
                 print("FIX\n%s\n%s\n" % (source, right))
 
-                element['steps'][1]['data'][0]['value'] = right
+                set_value(element, 'source', right)
+                # Logged: the search sync looks for new log entries
+                element[LOGS_COLUMN] = element.get(LOGS_COLUMN, []) + [{
+                    TIME_COLUMN: time.time(), ACTION_COLUMN: 'fix_sources'}]
                 table.get(element['record']).update(element).run()
                 log.debug("Fixed %s" % element['record'])
                 # print("FOUND"); exit(1)
@@ -1,24 +1,41 @@
 # -*- coding: utf-8 -*-
 
+import os
 import re
+import time
 import logging
 import datetime
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from operations import html
+from operations.dedup import new_dedup, digest
+from operations.fields import \
+    MAIN_POSITION, MAIN_FIELDS, EXTRA_FIELDS, DATE
 from beeprint import pp
-from restapi.resources.services.rethink import RethinkConnection, RDBquery
+from restapi.resources.services.rethink import \
+    RethinkConnection, RDBquery, new_pooled_connection
 from restapi.resources.services.uploader import ZoomEnabling
 from restapi.resources.services.elastic import \
-    BASE_SETTINGS, ES_SERVICE, \
-    HTML_ANALYZER, EL_INDEX0, EL_INDEX1, EL_INDEX2, EL_INDEX3, \
-    EL_TYPE1, EL_TYPE2
+    BASE_SETTINGS, ES_SERVICE, EL_INDEX1, EL_INDEX2, EL_INDEX3, \
+    EL_TYPE1, EL_TYPE2, BulkIndexer, bulk_build, \
+    create_versioned, drop_versioned, swap_alias, swap_aliases
 
 from elasticsearch import Elasticsearch
 from restapi import get_logger
-from restapi.dates import set_date_period
+from restapi.dates import convert_to_ordered_string
 from restapi.commons.conversions import Utils
 
 RDB_TABLE1 = "datavalues"
 RDB_TABLE2 = "datadocs"
+# Processes transforming records (1 means no pipeline),
+# and records sent to a process at once
+R2E_WORKERS = int(os.environ.get('R2E_WORKERS', os.cpu_count() or 1))
+R2E_BATCH = int(os.environ.get('R2E_BATCH', 100))
 noimages = {}
 toberemoved = [
     # 'd2d5fcb6-81cc-4654-9f65-a436f0780c67'  # prova
@@ -182,9 +199,17 @@ RethinkConnection()
 query = RDBquery()
 # Elasticsearch object
 es = Elasticsearch(**ES_SERVICE)
+# Documents are sent in bulk requests
+indexer = BulkIndexer(es)
+# Where documents are written: the new generation of each index
+# (searches keep using the aliases until the rebuild completes)
+targets = {
+    EL_INDEX1: EL_INDEX1, EL_INDEX2: EL_INDEX2, EL_INDEX3: EL_INDEX3,
+}
 
-_cache = {}
-transcrpcache = []
+# Suggestions (label and value) and transcriptions already seen
+_cache = new_dedup()
+transcrpcache = new_dedup()
 u = Utils()
 
 
@@ -222,9 +247,7 @@ def add_suggestion(key, value, probability=1, extra=None, is_extrait=False):
         # time.sleep(3)
 
     # Handle cache
-    if key not in _cache:
-        _cache[key] = {}
-    if value in _cache[key]:
+    if (key + '\0' + value) in _cache:
         # print("Skipping")
         return False
 
@@ -243,41 +266,41 @@ def add_suggestion(key, value, probability=1, extra=None, is_extrait=False):
             'extra': extra
         }
 
-        # ADD
-        es.index(index=EL_INDEX2, doc_type=EL_TYPE2, body=body)
+        # ADD (same label and value, same document: the sync worker
+        # starts without the cache and must not write duplicates)
+        indexer.add(targets[EL_INDEX2], EL_TYPE2, body,
+                    id=digest(key + '\0' + value).hex())
 
-    _cache[key][value] = True
+    _cache.add(key + '\0' + value)
     # cache also with ending s?
     last_char = value_len - 1
     if value[last_char] in 'aeiou':
-        _cache[key][value + 's'] = True
+        _cache.add(key + '\0' + value + 's')
 
     # print("Suggest adding", key, value, probability)
     return True
 
 
-def suggest_transcription(transcription, key, probability=0.5, extrait=None):
+def suggest_transcription(transcription, key, probability=0.5, extrait=None,
+                          suggest=add_suggestion):
 
     if transcription is None or transcription.strip() == '':
         return False
 
-    if transcription in transcrpcache:
+    if not transcrpcache.add(transcription):
         # logger.debug("Suggestion already cached")
         return False
 
     # print("Suggest ", key)
-    transcrpcache.append(transcription)
     # if '[Non transcrit]' in transcription:
     #     return False
 
-    words = es.indices.analyze(
-        index=EL_INDEX0, analyzer='my_html_analyzer', body=transcription)
-
-    for token in words['tokens']:
+    # Tokens of the 'my_html_analyzer' once used through Elasticsearch
+    for token in html.tokenize(transcription):
         for word in token['token'].split("'"):
             token['cleanlabel'] = key.split('_')[0]
             if len(word) > 2:
-                add_suggestion(key, word, probability, extra=token)
+                suggest(key, word, probability, extra=token)
 
     return True
 
@@ -286,7 +309,7 @@ def read_xls():
 
     # NEW
     from .gxls import GExReader
-    obj = GExReader(rethink=query, elastic=es)
+    obj = GExReader(rethink=query, elastic=es, index=targets[EL_INDEX3])
     obj.get_data()
 
     # # OLD
@@ -309,6 +332,24 @@ def single_update(doc):
         logger.info("Removed useless %s" % record)
         return None
 
+    elobj = transform(doc)
+    if elobj is None:
+        return None
+
+    ###################
+    # save
+    indexer.add(targets[EL_INDEX1], EL_TYPE1, elobj, id=record)
+    return elobj
+
+
+def transform(doc, docs=None, suggest=add_suggestion):
+    """
+    The search document of a record.
+    'docs' are its datadocs, if already read;
+    'suggest' receives the suggestions found along the way.
+    """
+
+    record = doc['record']
     elobj = {}
     not_valid = False
 
@@ -327,58 +368,26 @@ def single_update(doc):
         # Add extra search elements
         for element in step['data']:
             pos = element['position']
-            extrakey = None
             # print("Current step", current_step, pos)
-            if pos == 1:
+            if pos == MAIN_POSITION:
                 value = element['value']
                 # break
 
             if 'value' in element and len(element['value']) > 0:
-                if current_step == 1:
-                    if pos == 2:
-                        extrakey = 'page'
-                    if pos == 3:
-                        # element['value'] = False
-                        extrakey = 'gravure'
-                        if 'gravure' in element['value'].lower():
-                            element['value'] = True
-                            # print("FOUND!\n\n")
-                        else:
-                            element['value'] = False
-                    # if pos == 5:
-                    #     print("TEST!\n\n", element)
-                    #     exit(1)
-                    #     extrakey = 'gravure'
-                if current_step == 2:
-                    if pos == 2:
-                        extrakey = 'manuscrit'
-                elif current_step == 3:
-                    if pos == 4:
-                        # extrakey = 'date'
-                        date['year'] = int(element['value'])
-                    elif pos == 5:
-                        extrakey = 'lieu'
-                    elif pos == 8:
-                        date['start'] = element['value']
-                    elif pos == 9:
-                        date['end'] = element['value']
-                    # elif pos > 9:
-                    #     if len(date) < 1:
-                    #         pp(elobj)
-                    #         time.sleep(5)
-                elif current_step == 4:
-                    if pos == 6:
-                        extrakey = 'apparato'
-                    elif pos == 4:
-                        extrakey = 'actions'
-                    elif pos == 3:
-                        extrakey = 'temps'
-
-                if extrakey is not None:
+                mapped = EXTRA_FIELDS.get((current_step, pos))
+                if mapped is None:
+                    continue
+                group, extrakey, converter = mapped
+                if converter is not None:
+                    element['value'] = converter(element['value'])
+                if group == DATE:
+                    date[extrakey] = element['value']
+                else:
                     # print("TEST", extrakey, "*" + element['value'] + "*")
-                        elobj[extrakey] = element['value']
+                    elobj[extrakey] = element['value']
 
         #############################
+        key = MAIN_FIELDS.get(current_step)
         if current_step == 1:
             if value is None:
                 logger.error("Invalid element %s" % record)
@@ -401,7 +410,6 @@ def single_update(doc):
             #     return
             # https://stackoverflow.com/a/34378962
 
-            key = 'extrait'
             try:
                 ##########################
                 # sorting stuff
@@ -437,18 +445,16 @@ def single_update(doc):
                     if ' ' in suggest_value:
                         suggest_value = '"%s"' % suggest_value
                 # print("TEST ME", suggest_value)
-                add_suggestion(key, suggest_value, prob, is_extrait=True)
+                suggest(key, suggest_value, prob, is_extrait=True)
 
             except Exception as e:
                 print("VALUES WAS", value, step)
                 raise e
 
-        elif current_step == 2:
-            key = 'source'
-            # add_suggestion(key, value, .9)
+        # elif current_step == 2:
+        #     add_suggestion(key, value, .9)
 
         elif current_step == 3:
-            key = 'fete'
             # add_suggestion(key, value, .7)
             # if value == 'prova':
             #     print("STOP!")
@@ -470,14 +476,12 @@ def single_update(doc):
         return
 
     # Update with data from the images and translations + transcriptions
-    exist = query.get_table_query(RDB_TABLE2) \
-        .get_all(record).count().run()
+    if docs is None:
+        docs = list(query.get_table_query(RDB_TABLE2).get_all(record).run())
 
-    if exist:
+    if len(docs) > 0:
         docobj = {}
-        doc_cursor = query.get_table_query(RDB_TABLE2) \
-            .get_all(record).run()
-        data = list(doc_cursor).pop(0)
+        data = docs[0]
         image = data['images'].pop(0)
         # print(image)
 
@@ -516,7 +520,8 @@ def single_update(doc):
             docobj[key] = html.convert(value)
             # add suggestion
             name = key.split('_')[0]
-            suggest_transcription(docobj[key], name, .3, elobj['extrait'])
+            suggest_transcription(
+                docobj[key], name, .3, elobj['extrait'], suggest=suggest)
 
         docobj['thumbnail'] = ZoomEnabling.get_thumbname(image['filename'])
         elobj['doc'] = docobj
@@ -534,11 +539,6 @@ def single_update(doc):
 
     # Input date(year, start, end)
     if len(date) > 0:
-        objdate = {
-            'years': {'start': None, 'end': None},
-            'months': {'start': None, 'end': None},
-            'days': {'start': None, 'end': None}
-        }
 
         if 'year' in date:
 
@@ -552,88 +552,181 @@ def single_update(doc):
                     year=date['year'], month=12, day=31).isoformat()
                 elobj['end_date'] = x + '.000Z'
 
-            # String representation
-            tmp = str(date['year'])
-            objdate['years']['start'] = tmp
-            objdate['years']['end'] = tmp
-
         if 'start' in date:
             elobj['start_date'] = date['start']
-            objdate = set_date_period(date, objdate, code='start')
 
         if 'end' in date:
             elobj['end_date'] = date['end']
-            objdate = set_date_period(date, objdate, code='end')
-
-        # build the date string to show inside the search like
-        # 1622 / 03-04 / 11-19
-        newyear = str(objdate['years']['start'])
-        if objdate['years']['end'] != objdate['years']['start']:
-            newyear += '-' + str(objdate['years']['end'])
-
-        newmonth = ''
-        if objdate['months']['start'] is not None:
-            newmonth = str(objdate['months']['start']).zfill(2)
-        if objdate['months']['end'] is not None:
-            if objdate['months']['end'] != objdate['months']['start']:
-                if newmonth != '':
-                    newmonth += '-'
-                newmonth += str(objdate['months']['end']).zfill(2)
-        if newmonth != '':
-            newmonth += ' / '
-
-        newday = ''
-        if objdate['days']['start'] is not None:
-            newday = str(objdate['days']['start']).zfill(2)
-        if objdate['days']['end'] is not None:
-            if objdate['days']['end'] != objdate['days']['start']:
-                if newday != '':
-                    newday += '-'
-                newday += str(objdate['days']['end']).zfill(2)
-        if newday != '':
-            newday += ' / '
-
-        elobj['date'] = newday + newmonth + newyear
+
+        # the date string to show inside the search like
+        # 11-19 / 03-04 / 1622
+        elobj['date'] = convert_to_ordered_string(
+            date, separator=' / ', day_first=True)
 
     else:
         print("FAIL", doc['steps'][2])
         exit(1)
 
-    ###################
-    # save
-    es.index(index=EL_INDEX1, id=record, body=elobj, doc_type=EL_TYPE1)
-    print("")
     return elobj
 
 
+#################################
+# PIPELINE
+#################################
+def transform_batch(batch):
+    """
+    Inside a worker process: records become search documents.
+    Suggestions come back to the parent, which removes duplicates.
+    """
+
+    out = []
+    for doc, docs in batch:
+        suggestions = []
+        elobj = transform(
+            doc, docs,
+            suggest=lambda *args, **kwargs:
+            suggestions.append((args, kwargs)))
+        out.append((doc['record'], elobj, suggestions))
+    return out
+
+
+def read_batches(records, docs, batches, errors, size=R2E_BATCH):
+    """
+    Reader thread: records with their datadocs, in one stream.
+    The queue is bounded: reading waits for the transformations.
+    Table queries come from the main thread: here only its own connection.
+    """
+    try:
+        connection = new_pooled_connection()
+        cursor = records.merge(
+            lambda doc: {'_docs': docs.get_all(doc['record'])
+                         .coerce_to('array')}).run(connection)
+        batch = []
+        for doc in cursor:
+            if doc['record'] in toberemoved:
+                records.get(doc['record']).delete().run(connection)
+                logger.info("Removed useless %s" % doc['record'])
+                continue
+            batch.append((doc, doc.pop('_docs')))
+            if len(batch) >= size:
+                batches.put(batch)
+                batch = []
+        if len(batch) > 0:
+            batches.put(batch)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        batches.put(None)
+
+
+def write_results(results, errors, counter):
+    """ Writer thread: suggestions and documents to the bulk indexer """
+    while True:
+        out = results.get()
+        if out is None:
+            break
+        if len(errors) > 0:
+            # Keep consuming, so that the other stages never block
+            continue
+        try:
+            for record, elobj, suggestions in out:
+                for args, kwargs in suggestions:
+                    add_suggestion(*args, **kwargs)
+                if elobj is None:
+                    continue
+                if 'doc' not in elobj:
+                    noimages[elobj['extrait']] = elobj
+                indexer.add(targets[EL_INDEX1], EL_TYPE1, elobj, id=record)
+                counter.append(record)
+        except Exception as e:
+            errors.append(e)
+        logger.info("[Count %s]" % len(counter))
+
+
+def pipeline(workers=R2E_WORKERS):
+    """
+    Reader thread -> process pool -> writer thread,
+    with bounded queues so that no stage runs too far ahead.
+    """
+
+    # Tables may need to be created: only the main thread has a connection
+    records = query.get_table_query(RDB_TABLE1)
+    docs = query.get_table_query(RDB_TABLE2)
+
+    batches = queue.Queue(workers * 2)
+    results = queue.Queue(workers * 2)
+    errors = []
+    counter = []
+    reader = threading.Thread(
+        target=read_batches, args=(records, docs, batches, errors),
+        name='r2e-reader')
+    writer = threading.Thread(
+        target=write_results, args=(results, errors, counter),
+        name='r2e-writer')
+
+    pending = deque()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Fork the workers before any other thread is running
+            for future in [executor.submit(os.getpid)
+                           for _ in range(workers)]:
+                future.result()
+            for thread in [reader, writer]:
+                thread.daemon = True
+                thread.start()
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                pending.append(executor.submit(transform_batch, batch))
+                # Results keep the order of the records
+                if len(pending) >= workers * 2:
+                    results.put(pending.popleft().result())
+            while len(pending) > 0:
+                results.put(pending.popleft().result())
+    finally:
+        results.put(None)
+        if writer.ident is not None:
+            writer.join()
+
+    if len(errors) > 0:
+        # The new indices are incomplete: aliases must not move
+        raise errors[0]
+    return len(counter)
+
+
 #################################
 # MAIN
 #################################
-def make(only_xls=False, skip_lexique=False):
+def make(only_xls=False, skip_lexique=False, workers=R2E_WORKERS):
+
+    # New indices not yet behind their alias
+    pending = []
+    try:
+        return build(only_xls, skip_lexique, workers, pending)
+    except BaseException:
+        # A half built index must never be searched (nor rolled back to)
+        drop_versioned(es, *pending)
+        raise
+
+
+def build(only_xls, skip_lexique, workers, pending):
+
+    # Edits made while copying go only to the old generation
+    start = time.time()
 
     ###################
     if not only_xls:
 
-        q = query.get_table_query(RDB_TABLE1)
-        cursor = q.run()
         # print("SOME", cursor)
 
-        # HTML STRIPPER
-        if es.indices.exists(index=EL_INDEX0):
-            es.indices.delete(index=EL_INDEX0)
-        es.indices.create(index=EL_INDEX0, body=HTML_ANALYZER)
-
         # MULTI INDEX FILTERING
-        if es.indices.exists(index=EL_INDEX1):
-            es.indices.delete(index=EL_INDEX1)
-        es.indices.create(index=EL_INDEX1, body=INDEX_BODY1)
-        logger.info("Created index %s" % EL_INDEX1)
+        targets[EL_INDEX1] = create_versioned(es, EL_INDEX1, INDEX_BODY1)
+        pending.append(targets[EL_INDEX1])
 
         # SUGGESTIONS
-        if es.indices.exists(index=EL_INDEX2):
-            es.indices.delete(index=EL_INDEX2)
-        es.indices.create(index=EL_INDEX2, body=INDEX_BODY2)
-        logger.info("Created index %s" % EL_INDEX2)
+        targets[EL_INDEX2] = create_versioned(es, EL_INDEX2, INDEX_BODY2)
+        pending.append(targets[EL_INDEX2])
 
         # es.indices.put_mapping(
         #     index=EL_INDEX2, doc_type=EL_TYPE2, body=SUGGEST_MAPPINGS)
@@ -647,25 +740,48 @@ def make(only_xls=False, skip_lexique=False):
     # LEXIQUE
     if not skip_lexique:
 
-        if es.indices.exists(index=EL_INDEX3):
-            es.indices.delete(index=EL_INDEX3)
-        es.indices.create(index=EL_INDEX3, body={})
-        logger.info("Created index %s" % EL_INDEX3)
+        targets[EL_INDEX3] = create_versioned(es, EL_INDEX3)
+        pending.append(targets[EL_INDEX3])
 
         # READ FROM XLS FILE
         read_xls()
         # dictionary = read_xls(fix_suggest=(not only_xls))
+        swap_alias(es, EL_INDEX3, targets[EL_INDEX3])
+        pending.remove(targets[EL_INDEX3])
 
         if only_xls:
             return False
 
     ###################
     count = 0
-    for doc in cursor:
-        elobj = single_update(doc)
-        if elobj is not None:
-            count += 1
-            logger.info("[Count %s]\t%s" % (count, elobj['extrait']))
+    with bulk_build(es, targets[EL_INDEX1], targets[EL_INDEX2]):
+        if workers > 1:
+            count = pipeline(workers)
+        else:
+            cursor = query.get_table_query(RDB_TABLE1).run()
+            for doc in cursor:
+                elobj = single_update(doc)
+                if elobj is not None:
+                    count += 1
+                    logger.info("[Count %s]\t%s" % (count, elobj['extrait']))
+        indexer.close()
+    logger.info("Indexed %s records" % count)
+
+    # Searches switch to the new indices all at once
+    # (API servers see the change from their health checks,
+    # and drop the cached results of the old ones)
+    swap_aliases(es, dict(
+        (alias, targets[alias]) for alias in [EL_INDEX1, EL_INDEX2]))
+    for alias in [EL_INDEX1, EL_INDEX2]:
+        pending.remove(targets[alias])
+
+    # Records changed during the build, into the new generation;
+    # the sync worker goes on from here when it (re)starts
+    from operations import sync
+    synced = sync.sync_records(
+        sync.modified_records(start - sync.SYNC_SLACK))
+    sync.save_checkpoint(start)
+    logger.info("Synced %s records changed while building" % synced)
 
     # print("TOTAL", es.search(index=EL_INDEX1))
     print("Completed. No images:")
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+Keep the search index in sync with RethinkDB, without full rebuilds.
+
+Records changed (directly or through their documents) are read
+from changefeeds, grouped for a few seconds and sent to Elasticsearch
+in bulk, with the same transformation used by 'rethink2elastic.make'.
+
+The time of the latest batch is saved as a checkpoint:
+when the worker (re)starts, records modified after it are indexed again.
+Only writes appending to the 'logs' of a document are found that way:
+maintenance scripts updating documents have to log their changes too.
+A full rebuild saves its own start time as the checkpoint.
+"""
+
+import os
+import time
+import queue
+import threading
+import logging
+from rethinkdb import r, RqlDriverError, RqlRuntimeError
+from elasticsearch.helpers import scan
+from restapi import get_logger
+from restapi.resources.services.rethink import \
+    APP_DB, LOGS_COLUMN, TIME_COLUMN, new_pooled_connection
+from restapi.resources.services.connections import ConnectionPool
+from restapi.resources.services.elastic import EL_INDEX1, EL_TYPE1
+from operations import rethink2elastic as r2e
+
+# Where checkpoints are saved (one document for each index)
+SYNC_TABLE = 'elastic_sync'
+# Records for each bulk batch, and the longest wait before sending
+SYNC_BATCH = int(os.environ.get('SYNC_BATCH', 500))
+SYNC_INTERVAL = float(os.environ.get('SYNC_INTERVAL', 2))
+# Seconds a feed merges changes of the same record
+SYNC_SQUASH = float(os.environ.get('SYNC_SQUASH', 1))
+# Seconds read again before a checkpoint (clocks of different hosts)
+SYNC_SLACK = 60
+# Seconds before subscribing again to a broken feed
+SYNC_RETRY = 5
+
+logger = get_logger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+##############################
+# Checkpoint
+def read_checkpoint(index=EL_INDEX1):
+    query = r2e.query.get_query()
+    if SYNC_TABLE not in query.table_list().run():
+        query.table_create(SYNC_TABLE).run()
+        return None
+    checkpoint = query.table(SYNC_TABLE).get(index).run()
+    if checkpoint is None:
+        return None
+    return checkpoint[TIME_COLUMN]
+
+
+def save_checkpoint(timestamp, index=EL_INDEX1):
+    r2e.query.get_query().table(SYNC_TABLE).insert(
+        {'id': index, TIME_COLUMN: timestamp}, conflict='replace').run()
+
+
+##############################
+# Changes
+def record_changes(table):
+    """ The record of every changed document of a table """
+    return r.db(APP_DB).table(table) \
+        .changes(squash=SYNC_SQUASH, include_initial=False) \
+        .map(lambda change: r.branch(
+            change['new_val'].eq(None),
+            change['old_val'], change['new_val'])['record'].default(None)) \
+        .filter(lambda record: record.ne(None))
+
+
+def follow_changes(changes):
+    """
+    Put changed records inside the queue, forever.
+    None is put every time the feeds are (again) subscribed:
+    changes happened while not subscribed have to be read from the tables.
+    """
+    while True:
+        connection = None
+        try:
+            connection = new_pooled_connection()
+            cursor = record_changes(r2e.RDB_TABLE1) \
+                .union(record_changes(r2e.RDB_TABLE2)).run(connection)
+            changes.put(None)
+            logger.info("Following changes of '%s' and '%s'"
+                        % (r2e.RDB_TABLE1, r2e.RDB_TABLE2))
+            for record in cursor:
+                changes.put(record)
+        except (RqlDriverError, RqlRuntimeError) as e:
+            logger.warning("Changefeed interrupted: %s" % e)
+        finally:
+            if connection is not None:
+                ConnectionPool.close(connection)
+        time.sleep(SYNC_RETRY)
+
+
+def modified_records(since=None):
+    """ Records with a document logged after 'since' (all if None) """
+    records = set()
+    for table in [r2e.RDB_TABLE1, r2e.RDB_TABLE2]:
+        query = r2e.query.get_table_query(table)
+        if since is not None:
+            query = query.filter(
+                lambda doc:
+                doc[LOGS_COLUMN].nth(-1)[TIME_COLUMN].default(0) >= since)
+        records.update(query['record'].run())
+    return records
+
+
+def removed_records():
+    """ Indexed records not existing anymore """
+    existing = set(r2e.query.get_table_query(r2e.RDB_TABLE1)['record'].run())
+    indexed = set(
+        hit['_id'] for hit in scan(
+            r2e.es, index=EL_INDEX1, doc_type=EL_TYPE1,
+            query={'query': {'match_all': {}}}, _source=False))
+    return indexed - existing
+
+
+##############################
+# Sync
+def sync_records(records):
+    """ Index the current state of the records, in bulk batches """
+    records = list(records)
+    table = r2e.query.get_table_query(r2e.RDB_TABLE1)
+    for start in range(0, len(records), SYNC_BATCH):
+        batch = records[start:start + SYNC_BATCH]
+        found = set()
+        for doc in table.get_all(*batch).run():
+            found.add(doc['record'])
+            try:
+                elobj = r2e.single_update(doc)
+            except SystemExit:
+                # The full rebuild stops on broken records: not a worker
+                logger.error("Skipping invalid record %s" % doc['record'])
+                elobj = None
+            if elobj is None:
+                r2e.indexer.delete(r2e.targets[EL_INDEX1], EL_TYPE1,
+                                   doc['record'])
+        for record in set(batch) - found:
+            r2e.indexer.delete(r2e.targets[EL_INDEX1], EL_TYPE1, record)
+        r2e.indexer.flush()
+    return len(records)
+
+
+def catch_up():
+    """ Everything changed since the checkpoint """
+    start = time.time()
+    since = read_checkpoint()
+    if since is None:
+        logger.warning("No checkpoint: indexing all the records")
+    else:
+        since -= SYNC_SLACK
+    count = sync_records(modified_records(since) | removed_records())
+    save_checkpoint(start)
+    logger.info("Caught up with %s records in %.1f seconds"
+                % (count, time.time() - start))
+
+
+def run():
+    """ The worker: never returns """
+
+    changes = queue.Queue()
+    reader = threading.Thread(
+        target=follow_changes, args=(changes,), name='sync-feed')
+    reader.daemon = True
+    reader.start()
+
+    pending = set()
+    batch_start = None
+    while True:
+        try:
+            record = changes.get(timeout=SYNC_INTERVAL)
+        except queue.Empty:
+            record = False
+
+        if record is None:
+            catch_up()
+        elif record is not False:
+            if len(pending) < 1:
+                batch_start = time.time()
+            pending.add(record)
+
+        if len(pending) > 0 and (
+            len(pending) >= SYNC_BATCH or
+            time.time() - batch_start >= SYNC_INTERVAL
+        ):
+            sync_records(pending)
+            save_checkpoint(batch_start)
+            logger.debug("Synced %s records" % len(pending))
+            pending = set()
@@ -6,19 +6,25 @@ Load xlxs file (2010)
 
 from beeprint import pp
 # from openpyxl import load_workbook
+import numpy as np
 import pandas as pd
+from elasticsearch.helpers import bulk
 from restapi.resources.services.elastic import EL_INDEX3, EL_TYPE1
+from restapi.resources.services.rethink import RDB_BULK_SIZE
 import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 LEXIQUE_TABLE = 'lexique'
+# Columns filled with the latest value above, when empty
+FILLED_COLUMNS = {'macro': '-', 'micro': '-'}
 
 
 class ExReader(object):
     """ Reading spreadsheets from a file """
 
-    def __init__(self, filename=None, rethink=None, elastic=None):
+    def __init__(self, filename=None, rethink=None, elastic=None,
+                 index=EL_INDEX3):
 
         if rethink is not None:
             q = rethink.get_query()
@@ -38,6 +44,7 @@ class ExReader(object):
             self._el = elastic
         else:
             self._el = None
+        self._index = index
 
         if filename is None:
             filename = "/uploads/data/test2.xlsx"
@@ -73,6 +80,7 @@ class ExReader(object):
             })
 
         # pp(newset)
+        self.index_data(newset)
         return newset
 
     def save_data(self, ws, name):
@@ -85,59 +93,40 @@ class ExReader(object):
                 continue
             headers[col_name] = col_name.lower().split(' ')[0]
 
-        latest_macro = '-'
-        latest_micro = '-'
-        total_data = []
+        # Content: skip empty lines
+        ws = ws.dropna(how='all')[list(headers)].rename(columns=headers)
+        # Blank strings are empty cells
+        ws = ws.replace(r'^\s*$', np.nan, regex=True)
+        for column, default in FILLED_COLUMNS.items():
+            ws[column] = ws[column].ffill().fillna(default)
+        ws = ws.astype(object).where(ws.notnull(), None)
+        ws.insert(0, 'sheet', name)
+        total_data = ws.to_dict('records')
 
-        counter = 0
-        # Content
-        for i in ws.index:
+        ######################
+        # SAVE
 
-            # Skip empty lines
-            length = ws.loc[i].size
-            empty = sum(ws.loc[i].isnull()) == length
-            if empty:
-                continue
-
-            # Use current row
-            row = ws.loc[i]
-            data = {
-                'sheet': name
-            }
-            for key, value in row.items():
-                # print("UHM", key, value)
-                if pd.isnull(value):
-                    value = None
-                elif isinstance(value, str) and value.strip() == '':
-                    value = None
-                data[headers[key]] = value
-
-            if data['macro'] is not None:
-                latest_macro = data['macro']
-            else:
-                data['macro'] = latest_macro
-            if data['micro'] is not None:
-                latest_micro = data['micro']
-            else:
-                data['micro'] = latest_micro
-
-            total_data.append(data)
-
-            ######################
-            # SAVE
-
-            # Save rethinkdb
-            self._r.insert(data).run()
-            # Update elastic specific index
-            self._el.index(
-                index=EL_INDEX3, id=counter, body=data, doc_type=EL_TYPE1)
-
-            ######################
-            counter += 1
-            # exit(1)
+        # Save rethinkdb
+        for start in range(0, len(total_data), RDB_BULK_SIZE):
+            self._r.insert(total_data[start:start + RDB_BULK_SIZE]).run()
 
         return total_data
 
+    def index_data(self, sheets):
+        """ Update elastic specific index, with one bulk request """
+        actions = []
+        for sheet in sheets:
+            for counter, data in enumerate(sheet['data']):
+                actions.append({
+                    '_index': self._index, '_type': EL_TYPE1,
+                    '_id': counter, '_source': data})
+        indexed, errors = bulk(self._el, actions, raise_on_error=False)
+        if len(errors) > 0:
+            logger.error("Lexique: %s terms not indexed, e.g. %s"
+                         % (len(errors), errors[0]))
+        logger.info("Lexique: indexed %s terms" % indexed)
+        return indexed
+
 
 #     def read_block(self, data, emit_error=False):
 
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+Access log of the API requests.
+
+Writing logs is slow (formatting, locks, the stream itself):
+requests only put a small record inside a queue,
+and a background thread formats and writes it with the usual handlers.
+"""
+
+from __future__ import division, absolute_import
+from . import myself, lic, get_logger
+
+import os
+import time
+import random
+import logging
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+try:
+    import queue
+except ImportError:
+    # python2
+    import Queue as queue
+from flask import request, g
+from .serializer import dumps
+
+__author__ = myself
+__copyright__ = myself
+__license__ = lic
+
+logger = get_logger(__name__)
+
+# Fraction of requests to log (1 is all of them)
+ACCESS_LOG_SAMPLE = float(os.environ.get('ACCESS_LOG_SAMPLE', 1))
+# Characters of the request body inside a log line
+ACCESS_LOG_BODY_SIZE = int(os.environ.get('ACCESS_LOG_BODY_SIZE', 512))
+# Bodies bigger than this are never read just to log them
+ACCESS_LOG_BODY_READ = 64 * 1024
+# Records waiting for the writer; when full, new records are dropped
+ACCESS_LOG_QUEUE_SIZE = 10000
+
+
+class AccessEntry(dict):
+    """ Becomes a JSON string only when (and where) it gets written """
+
+    def __str__(self):
+        return dumps(self)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """ Never block or format inside the request thread """
+
+    dropped = 0
+
+    def prepare(self, record):
+        # Formatting is left to the handlers of the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def request_body():
+    """ A small piece of the body, if cheap to get """
+    length = request.content_length
+    if length is None or length == 0 or length > ACCESS_LOG_BODY_READ:
+        return length
+    body = request.get_data(cache=True, as_text=True)
+    if len(body) > ACCESS_LOG_BODY_SIZE:
+        body = body[:ACCESS_LOG_BODY_SIZE] + '...'
+    return body
+
+
+def init_access_log(app, sample=ACCESS_LOG_SAMPLE):
+    """ Access log for every (sampled) request of the Flask app """
+
+    access_logger = get_logger(__name__ + '.requests')
+    # The listener writes with the handlers already configured for root
+    handlers = logging.getLogger().handlers
+    records = queue.Queue(ACCESS_LOG_QUEUE_SIZE)
+    access_logger.addHandler(DroppingQueueHandler(records))
+    access_logger.propagate = False
+    listener = QueueListener(records, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.time()
+
+    @app.after_request
+    def log_response(response):
+        if sample < 1 and random.random() >= sample:
+            return response
+        start = g.get('request_start')
+        entry = AccessEntry(
+            method=request.method,
+            url=request.url,
+            status=response.status_code,
+            remote=request.remote_addr,
+            size=response.calculate_content_length(),
+            duration_ms=None if start is None else round(
+                (time.time() - start) * 1000, 2),
+        )
+        if request.method in ['POST', 'PUT', 'PATCH']:
+            entry['body'] = request_body()
+        access_logger.info("%s", entry)
+        return response
+
+    logger.debug("Access log: sampling %s of the requests" % sample)
+    return listener
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+Caching responses (and other things) inside the API server.
+
+The default backend is a bounded LRU living in the process memory.
+A shared backend (e.g. a redis client wrapper) can replace it:
+it only needs the same 'get', 'set', 'delete', 'incr', 'counter'
+and 'clear' methods.
+"""
+
+from __future__ import division, absolute_import
+from . import myself, lic, get_logger
+
+import time
+import threading
+from collections import OrderedDict
+
+__author__ = myself
+__copyright__ = myself
+__license__ = lic
+
+logger = get_logger(__name__)
+
+DEFAULT_CACHE_SIZE = 1024
+# Responses without a table to watch expire after some seconds
+DEFAULT_CACHE_TIMEOUT = 60
+
+
+##############################
+# Backends
+class LocalCache(object):
+    """ A thread-safe LRU with optional expiration (in seconds) """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, timeout=None):
+        super(LocalCache, self).__init__()
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        # Counters are not cached values: they are never evicted
+        self._counters = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                self.misses += 1
+                return default
+            # Most recently used goes at the end
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        expires = None
+        if timeout is not None:
+            expires = time.time() + timeout
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters.get(key, 0) + 1
+            self._counters[key] = value
+            return value
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses}
+
+
+##############################
+# Responses
+class ResponseCache(object):
+    """
+    Responses grouped by table.
+
+    Every table has a generation number inside the keys:
+    to invalidate all the responses of a table the generation is increased,
+    and the old entries will leave the LRU on their own.
+    """
+
+    def __init__(self, backend=None):
+        super(ResponseCache, self).__init__()
+        if backend is None:
+            backend = LocalCache()
+        self.backend = backend
+
+    def set_backend(self, backend):
+        self.backend = backend
+
+    def generation(self, table):
+        if table is None:
+            return 0
+        return self.backend.counter('generation:' + table)
+
+    def make_key(self, table, *parts):
+        return '%s:%s:%s' % (table, self.generation(table), repr(parts))
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout=timeout)
+
+    def invalidate(self, table):
+        generation = self.backend.incr('generation:' + table)
+        logger.debug("Cache of '%s' is now at generation %s"
+                     % (table, generation))
+        return generation
+
+
+response_cache = ResponseCache()
@@ -1,27 +1,86 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+from functools import lru_cache
 # import time
-# import datetime
+import datetime
 import timestring
 import dateutil.parser
 
+# Distinct date strings are a few: parse each of them once
+DATES_CACHE_SIZE = int(os.environ.get('DATES_CACHE_SIZE', 4096))
 
-def set_date_period(date, objdate, code='start'):
-    du = dateutil.parser.parse(date[code])
+# Formats of the archive: (pattern, group of year, month, day)
+DATE_FORMATS = [
+    # ISO: yyyy-MM-dd, with an optional time
+    (re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})(?:[T ].*)?$'), 1, 2, 3),
+    # dd-MM-yyyy
+    (re.compile(r'^(\d{1,2})-(\d{1,2})-(\d{4})$'), 3, 2, 1),
+    # MM-yyyy
+    (re.compile(r'^(\d{1,2})-(\d{4})$'), 2, 1, None),
+    # yyyy-MM
+    (re.compile(r'^(\d{4})-(\d{1,2})$'), 1, 2, None),
+    # yyyy
+    (re.compile(r'^(\d{4})$'), 1, None, None),
+]
+
+
+@lru_cache(maxsize=DATES_CACHE_SIZE)
+def parse_date(text):
+    """ (year, month, day): missing parts of known formats are None """
+    text = text.strip()
+    for pattern, year, month, day in DATE_FORMATS:
+        match = pattern.match(text)
+        if match is None:
+            continue
+        parts = tuple(
+            None if group is None else int(match.group(group))
+            for group in (year, month, day))
+        # Only real dates (e.g. not 31-02-1622)
+        try:
+            datetime.date(parts[0], parts[1] or 1, parts[2] or 1)
+        except ValueError:
+            break
+        return parts
+    # Anything else: the (slow) generic parsers
+    du = dateutil.parser.parse(text)
     t = timestring.Date(du)
-    objdate['years'][code] = t.year
-    objdate['months'][code] = t.month
-    objdate['days'][code] = t.day
+    return (t.year, t.month, t.day)
+
+
+def set_date_period(date, objdate, code='start'):
+    year, month, day = parse_date(date[code])
+    objdate['years'][code] = year
+    objdate['months'][code] = month
+    objdate['days'][code] = day
     return objdate
 
 
-def convert_to_ordered_string(date):
+def period_string(objdate, name):
+    """ e.g. '03', or '03-04' when start and end differ """
+    start = objdate[name]['start']
+    end = objdate[name]['end']
+    out = ''
+    if start is not None:
+        out = str(start).zfill(2)
+    if end is not None and end != start:
+        if out != '':
+            out += '-'
+        out += str(end).zfill(2)
+    return out
+
+
+def convert_to_ordered_string(date, separator=' ', day_first=False):
     """
     date = {
         'start': ... ,
         'end': ... ,
         'year': ... ,
     }
+
+    e.g. '1622 03-04 11-19',
+    or '11-19 / 03-04 / 1622' with separator ' / ' and day_first
     """
     objdate = {
         'years': {'start': None, 'end': None},
@@ -41,31 +100,23 @@ def convert_to_ordered_string(date):
     if 'end' in date:
         objdate = set_date_period(date, objdate, code='end')
 
-    # build the date string to show inside the search like
-    # 1622 / 03-04 / 11-19
+    # build the date string to show inside the search
     newyear = str(objdate['years']['start'])
     if objdate['years']['end'] != objdate['years']['start']:
         newyear += '-' + str(objdate['years']['end'])
 
-    newmonth = ' '
-    if objdate['months']['start'] is not None:
-        newmonth += str(objdate['months']['start']).zfill(2)
-    if objdate['months']['end'] is not None:
-        if objdate['months']['end'] != objdate['months']['start']:
-            if newmonth != '':
-                newmonth += '-'
-            newmonth += str(objdate['months']['end']).zfill(2)
-
-    newday = ' '
-    if objdate['days']['start'] is not None:
-        newday += str(objdate['days']['start']).zfill(2)
-    if objdate['days']['end'] is not None:
-        if objdate['days']['end'] != objdate['days']['start']:
-            if newday != '':
-                newday += '-'
-            newday += str(objdate['days']['end']).zfill(2)
+    newmonth = period_string(objdate, 'months')
+    newday = period_string(objdate, 'days')
+
+    if day_first:
+        # empty parts are skipped
+        final_date = ''
+        for part in [newday, newmonth]:
+            if part != '':
+                final_date += part + separator
+        return final_date + newyear
 
     # final_date = newday + newmonth + newyear
-    final_date = newyear + newmonth + newday
+    final_date = newyear + separator + newmonth + separator + newday
 
     return final_date
@@ -13,18 +13,12 @@ source: http://flask.pocoo.org/snippets/83/
 from __future__ import division, absolute_import
 from . import myself, lic, get_logger
 
-from flask import jsonify, make_response
+from flask import jsonify, make_response, Response, stream_with_context
 from werkzeug.exceptions import HTTPException
 from . import htmlcodes as hcodes
-
-# Look for the best chance for json lib
-try:
-    import simplejson as json
-except:
-    try:
-        import commentjson as json
-    except:
-        import json
+# The fastest json library available
+from .serializer import dumps, loads
+from .timing import timed
 
 __author__ = myself
 __copyright__ = myself
@@ -32,6 +26,14 @@ __license__ = lic
 
 logger = get_logger(__name__)
 
+# Newline delimited JSON: one document per line
+NDJSON_MIMETYPES = ['application/x-ndjson', 'application/ndjson']
+# A normal JSON array, but written while reading the data
+JSON_STREAM_MIMETYPE = 'application/stream+json'
+STREAM_MIMETYPES = NDJSON_MIMETYPES + [JSON_STREAM_MIMETYPE]
+# Do not send a network chunk for every single (small) document
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 ##############################
 # Json Serialization for more than simple returns
@@ -49,13 +51,62 @@ def make_json_error(ex):
 
 ##############################
 # Json Serialization as written in restful docs
+@timed('json.output')
 def output_json(data, code, headers=None):
     """Makes a Flask response with a JSON encoded body"""
-    resp = make_response(json.dumps(data), code)
+    resp = make_response(dumps(data), code)
     resp.headers.extend(headers or {})
     return resp
 
 
+def parse_ndjson(text):
+    """ From NDJSON text to a list of objects (empty lines are skipped) """
+    return [loads(line) for line in text.splitlines() if line.strip()]
+
+
+##############################
+# Streaming: memory stays flat, whatever the size of the result
+def buffered(pieces, size=STREAM_CHUNK_SIZE):
+    """ Join small strings into chunks of about 'size' characters """
+    buffer = []
+    length = 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+    if len(buffer) > 0:
+        yield ''.join(buffer)
+
+
+def stream_ndjson(documents):
+    for document in documents:
+        yield dumps(document) + '\n'
+
+
+def stream_json_array(documents):
+    separator = '['
+    for document in documents:
+        yield separator + dumps(document)
+        separator = ','
+    if separator == '[':
+        yield separator
+    yield ']'
+
+
+def output_stream(documents, mimetype, code=hcodes.HTTP_OK_BASIC):
+    """ A Flask streaming response, from any iterable (e.g. a db cursor) """
+    if mimetype in NDJSON_MIMETYPES:
+        pieces = stream_ndjson(documents)
+    else:
+        pieces = stream_json_array(documents)
+    # The request context (and its db connection) lives until the end
+    return Response(stream_with_context(buffered(pieces)),
+                    status=code, mimetype=mimetype)
+
+
 ####################################
 # Custom error handling: SAVE TO LOG
 # http://flask-restful.readthedocs.org/en/latest/
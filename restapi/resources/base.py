@@ -2,9 +2,14 @@
 
 """ Basic Resource """
 
+import json
+import base64
+import hashlib
+import calendar
+from flask import after_this_request, make_response
 from .. import htmlcodes as hcodes
 # from confs.config import STACKTRACE
-from ..jsonify import output_json  # , RESTError
+from ..jsonify import output_json, RESTError
 from flask_restful import request, Resource, reqparse, fields  # , abort
 from .. import get_logger
 
@@ -14,6 +19,10 @@ CURRENTPAGE_KEY = 'currentpage'
 DEFAULT_CURRENTPAGE = 1
 PERPAGE_KEY = 'perpage'
 DEFAULT_PERPAGE = 10
+CURSOR_KEY = 'cursor'
+# Where decorators attach parameters to a method
+PARAMETERS_ATTRIBUTE = 'endpoint_parameters'
+API_METHODS = ['get', 'post', 'put', 'patch', 'delete']
 
 
 # Extending the concept of rest generic resource
@@ -23,8 +32,16 @@ class ExtendedApiResource(Resource):
     myname = __name__
     _args = {}
     _params = {}
+    # Compiled parsers, for each (resource class, method)
+    _parsers = {}
+    _parser = None
     endtype = None
     endpoint = None
+    # Token to reach the next page, if the resource can provide it
+    next_cursor = None
+    # What identifies the state of the data (if known) and when it changed
+    version = None
+    last_modified = None
     hcode = hcodes.HTTP_OK_BASIC
     # How to have a standard response
     resource_fields = {
@@ -47,8 +64,6 @@ class ExtendedApiResource(Resource):
         }
         # Apply decision about the url of endpoint
         self.set_endpoint()
-        # Make sure you can parse arguments at every call
-        self._parser = reqparse.RequestParser()
 
     @staticmethod
     def clean_parameter(param=""):
@@ -102,7 +117,7 @@ class ExtendedApiResource(Resource):
             return self._args.get(single_parameter)
 
         if len(self._args) > 0:
-            logger.info("Parameters %s" % self._args)
+            logger.debug("Parameters %s" % self._args)
         return self._args
 
     def get_input(self, forcing=True):
@@ -121,31 +136,45 @@ class ExtendedApiResource(Resource):
         # Avoid if already exists?
         if name not in self._params[key]:
             self._params[key][name] = [mytype, default, required]
+            # Parsers of this class have to be compiled again
+            for parser_key in list(self._parsers):
+                if parser_key[0] is self.__class__:
+                    self._parsers.pop(parser_key, None)
 
-    def apply_parameters(self):
-        """ Use parameters received via decoration """
-
-        key = self.myname()
-        if key not in self._params:
-            self._params[key] = {}
-            # return False
+    @classmethod
+    def get_parser(cls, method=None, parameters=()):
+        """
+        Parameters become a parser only once
+        for each resource class and method: requests only parse.
+        """
+        key = (cls, method)
+        parser = cls._parsers.get(key)
+        if parser is not None:
+            return parser
 
         ##############################
         # Basic options
         basevalue = str  # Python3
         # basevalue = unicode  #Python2
-        act = 'store'  # store is normal, append is a list
         loc = ['headers', 'values']  # multiple locations
         trim = True
 
-# // TO FIX?
-        self._params[key][PERPAGE_KEY] = (int, DEFAULT_PERPAGE, False)
-        self._params[key][CURRENTPAGE_KEY] = (int, DEFAULT_CURRENTPAGE, False)
+        params = {
+            PERPAGE_KEY: (int, DEFAULT_PERPAGE, False),
+            CURRENTPAGE_KEY: (int, DEFAULT_CURRENTPAGE, False),
+            CURSOR_KEY: (str, None, False),
+        }
+        # Saved inside the class, then decorating the method
+        params.update(cls._params.get(cls.__name__, {}))
+        for name, param_type, param_default, param_required in parameters:
+            params[name] = (param_type, param_default, param_required)
 
+        parser = reqparse.RequestParser()
         for param, \
             (param_type, param_default, param_required) in \
-                self._params[key].items():
+                params.items():
 
+            act = 'store'  # store is normal, append is a list
             # Decide what is left for this parameter
             if param_type is None:
                 param_type = basevalue
@@ -156,22 +185,127 @@ class ExtendedApiResource(Resource):
                 act = 'append'
 
             # Really add the parameter
-            self._parser.add_argument(
+            parser.add_argument(
                 param, type=param_type,
                 default=param_default, required=param_required,
                 trim=trim, action=act, location=loc)
-            logger.info("Accept param '%s', type %s" % (param, param_type))
 
+        logger.info("[%s] %s accepts params %s"
+                    % (cls.__name__, method, sorted(params)))
+        cls._parsers[key] = parser
+        return parser
+
+    @classmethod
+    def compile_parsers(cls):
+        """ At endpoint registration: prepare parsers for API methods """
+        for method in API_METHODS:
+            function = getattr(cls, method, None)
+            if function is None:
+                continue
+            cls.get_parser(
+                method, getattr(function, PARAMETERS_ATTRIBUTE, ()))
+
+    def apply_parameters(self, method=None, parameters=()):
+        """ Use parameters received via decoration """
+        self._parser = self.get_parser(method, parameters)
         return True
 
     def set_method_id(self, name='myid', idtype='string'):
         """ How to have api/method/:id route possible"""
         self.endtype = idtype + ':' + name
 
-    def get_paging(self):
+    def get_paging(self, with_cursor=False):
+        """
+        Two ways of paging:
+        offset with 'currentpage' (fine for the first pages),
+        or keyset with the 'cursor' token received with the previous page.
+        """
         limit = self._args.get(PERPAGE_KEY, DEFAULT_PERPAGE)
         current_page = self._args.get(CURRENTPAGE_KEY, DEFAULT_CURRENTPAGE)
-        return (current_page, limit)
+        if not with_cursor:
+            return (current_page, limit)
+        token = self.clean_parameter(self._args.get(CURSOR_KEY))
+        return (current_page, limit, self.decode_cursor(token))
+
+    @staticmethod
+    def encode_cursor(value):
+        """ An opaque token for the client, from the last key of a page """
+        raw = json.dumps(value).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(token):
+        if token is None or token == '':
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(token.encode('ascii'))
+            return json.loads(raw.decode('utf-8'))
+        except (ValueError, TypeError):
+            raise RESTError("Invalid paging cursor",
+                            status_code=hcodes.HTTP_BAD_REQUEST)
+
+    ##############################
+    # Conditional requests
+    @staticmethod
+    def is_conditional():
+        return request.method == 'GET' and \
+            (bool(request.if_none_match) or
+             request.if_modified_since is not None)
+
+    def make_etag(self):
+        """ From the data version: it can be checked before querying """
+        raw = json.dumps(
+            [request.full_path, self.version], sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def not_modified(self, etag, last_modified=None):
+        """
+        The client already has this version of the data.
+        If-Modified-Since counts only with a Last-Modified time
+        """
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+        since = request.if_modified_since
+        if last_modified is not None and since is not None:
+            return int(last_modified) <= \
+                calendar.timegm(since.utctimetuple())
+        return False
+
+    @staticmethod
+    def cache_validators(etag, last_modified=None):
+        """ Send ETag and Last-Modified with the response of this request """
+        @after_this_request
+        def add_validators(response):
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = int(last_modified)
+            return response
+
+    @staticmethod
+    def content_validators():
+        """
+        Without a version: the ETag is a digest of the JSON
+        already written for the response of this request
+        """
+        @after_this_request
+        def add_validators(response):
+            if response.status_code != hcodes.HTTP_OK_BASIC or \
+                    response.is_streamed:
+                return response
+            etag = hashlib.sha1(response.get_data()).hexdigest()
+            response.set_etag(etag, weak=True)
+            if request.if_none_match.contains_weak(etag):
+                response.status_code = hcodes.HTTP_NOT_MODIFIED
+                response.set_data(b'')
+            return response
+
+    @staticmethod
+    def not_modified_response(etag, last_modified=None):
+        response = make_response('', hcodes.HTTP_NOT_MODIFIED)
+        response.set_etag(etag, weak=True)
+        if last_modified is not None:
+            response.last_modified = int(last_modified)
+        return response
 
     def response(self, obj=None,
                  elements=0, data_type='dict',
@@ -213,6 +347,18 @@ class ExtendedApiResource(Resource):
                 'data_type': data_type,
                 'status': code
             }
+            if self.next_cursor is not None:
+                response['cursor'] = self.next_cursor
+
+        # Validators, and nothing to send if the client is up to date
+        if request.method == 'GET' and code == hcodes.HTTP_OK_BASIC:
+            if self.version is None:
+                self.content_validators()
+            else:
+                etag = self.make_etag()
+                self.cache_validators(etag, self.last_modified)
+                if self.not_modified(etag, self.last_modified):
+                    return None, hcodes.HTTP_NOT_MODIFIED
 
         # ## In case we want to handle the failure at this level
         # # I want to use the same marshal also if i say "fail"
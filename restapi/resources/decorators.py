@@ -20,10 +20,15 @@ different solutions.
 from __future__ import division, absolute_import
 from .. import myself, lic, get_logger
 
-from flask_restful import marshal
+from functools import wraps
+from flask import current_app
+from flask_restful import marshal, request
 from flask.wrappers import Response
+from flask_security import current_user
 from .. import htmlcodes as hcodes
 from ..meta import Meta
+from ..cache import response_cache, DEFAULT_CACHE_TIMEOUT
+from .base import PARAMETERS_ATTRIBUTE, API_METHODS
 
 __author__ = myself
 __copyright__ = myself
@@ -68,32 +73,21 @@ def enable_endpoint_identifier(name='myid', idtype='string'):
 # http://scottlobdell.me/2015/04/decorators-arguments-python/
 
 def add_endpoint_parameter(name, ptype=str, default=None, required=False):
-    """ 
-    Add a new parameter to the whole endpoint class.
+    """ 
+    Add a new parameter to the method of an endpoint class.
     Parameters are the ones passed encoded in the url, e.g.
 
     GET /api/myendpoint?param1=string&param2=42
 
-    Note: it could become specific to the method with using subarrays
+    Note: nothing happens at call time. The parameter is attached to
+    the method and compiled into a parser once (see 'get_parser').
     Another note: you could/should use JSON instead...
     """
     def decorator(func):
-        def wrapper(self, *args, **kwargs):
-            # Debug
-            class_name = self.__class__.__name__
-            logger.debug("[Class: %s] Decorated to add parameter '%s'"
-                         % (class_name, name))
-
-            params = {
-                'name': name,
-                # Check list type? for filters
-                'mytype': ptype,
-                'default': default,
-                'required': required,
-            }
-            self.add_parameter(**params)
-            return func(self, *args, **kwargs)
-        return wrapper
+        parameters = [(name, ptype, default, required)]
+        parameters.extend(getattr(func, PARAMETERS_ATTRIBUTE, []))
+        setattr(func, PARAMETERS_ATTRIBUTE, parameters)
+        return func
     return decorator
 
 
@@ -119,14 +113,18 @@ def apimethod(func):
     Decorate methods to return the most standard json data
     and also to parse available args before using them in the function
     """
+    # Parameters declared below are copied now: decorating the wrapper
+    # adds to them, and the parser is compiled only once
+    @wraps(func)
     def wrapper(self, *args, **kwargs):
         # Debug
         class_name = self.__class__.__name__
         method_name = func.__name__.upper()
-        logger.info("[Class: %s] %s request" % (class_name, method_name))
+        logger.debug("[Class: %s] %s request" % (class_name, method_name))
 
         # Call the parse method
-        self.apply_parameters()
+        self.apply_parameters(
+            func.__name__, getattr(wrapper, PARAMETERS_ATTRIBUTE, []))
         self.parse()
         # Call the wrapped function
         try:
@@ -168,6 +166,71 @@ def apimethod(func):
     return wrapper
 
 
+##############################
+# Caching GET responses of a resource
+
+def current_roles():
+    """ Users with different roles may see different responses """
+    # Without security there is no login manager behind 'current_user'
+    if 'security' not in current_app.extensions:
+        return ()
+    if not current_user or not current_user.is_authenticated:
+        return ()
+    return tuple(sorted(role.name for role in current_user.roles))
+
+
+def enable_response_cache(table=None, timeout=None):
+    """
+    Class decorator for ExtendedApiResource objects;
+    GET responses are cached on endpoint, arguments and user roles.
+
+    If the resource works on a RethinkDB table (the 'table' attribute
+    or the decorator argument) a changefeed on that table invalidates
+    the cache. Otherwise entries expire after 'timeout' seconds.
+    """
+    def class_rebuilder(cls):   # decorator
+
+        original_get = cls.get
+
+        # Keep the parameters attached to the original method
+        @wraps(original_get)
+        def get(self, *args, **kwargs):
+            mytable = table or getattr(self, 'table', None)
+            mytimeout = timeout
+            if mytable is None:
+                if mytimeout is None:
+                    mytimeout = DEFAULT_CACHE_TIMEOUT
+            else:
+                from .services.rethink import watch_table
+                # Without a live changefeed data could be stale
+                if not watch_table(
+                        mytable, lambda change: response_cache.invalidate(
+                            mytable), name='response_cache'):
+                    return original_get(self, *args, **kwargs)
+
+            key = response_cache.make_key(
+                mytable, request.full_path, str(request.accept_mimetypes),
+                args, sorted(kwargs.items()), current_roles())
+            out = response_cache.get(key)
+            if out is not None:
+                logger.debug("Cached response for %s" % request.full_path)
+                return out
+
+            out = original_get(self, *args, **kwargs)
+            # Only complete and positive responses
+            if isinstance(out, Response):
+                return out
+            if isinstance(out, tuple) and len(out) == 2 and \
+                    out[1] != hcodes.HTTP_OK_BASIC:
+                return out
+            response_cache.set(key, out, timeout=mytimeout)
+            return out
+
+        setattr(cls, 'get', get)
+        return cls
+    return class_rebuilder
+
+
 ##############################
 # A decorator for the whole class
 
@@ -175,7 +238,7 @@ def all_rest_methods(decorator):
     """ Decorate all the api methods inside one class """
 
 # ADD OTHER METHODS HERE, IF SOME ARE MISSING
-    api_methods = ['get', 'post', 'put', 'patch', 'delete']  # , 'search']
+    api_methods = API_METHODS  # , 'search']
 
     def decorate(cls):
         # there's propably a better way to do this
@@ -33,6 +33,9 @@ class Endpoints(object):
             if endkey is not None:
                 urls.append(address + '/<' + endkey + '>')
 
+        # Parameters are compiled once, here
+        if hasattr(resource, 'compile_parsers'):
+            resource.compile_parsers()
         # Create the restful resource with it
         self.rest_api.add_resource(resource, *urls)
 
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""
+MONITORING ENDPOINTS
+How the server is performing, only for administrators
+"""
+
+from __future__ import division, absolute_import
+from .. import myself, lic, get_logger
+from .base import ExtendedApiResource
+from . import decorators as decorate
+from ..timing import timings
+from flask_security import roles_required, auth_token_required
+from confs import config
+
+__author__ = myself
+__copyright__ = myself
+__license__ = lic
+
+logger = get_logger(__name__)
+
+
+class ServerTimings(ExtendedApiResource):
+    """ Percentiles (ms) for each endpoint and backend operation """
+
+    endpoint = 'admin/timings'
+
+    @decorate.apimethod
+    @auth_token_required
+    @roles_required(config.ROLE_ADMIN)
+    def get(self):
+        return self.response(timings.summary())
+
+
+class ServerIndexes(ExtendedApiResource):
+    """ Secondary indexes declared in models, and if they are ready """
+
+    endpoint = 'admin/indexes'
+
+    @decorate.apimethod
+    @auth_token_required
+    @roles_required(config.ROLE_ADMIN)
+    def get(self):
+        # Only where RethinkDB is available
+        from .services.rethink import index_manager
+        return self.response(index_manager.status())
+
+
+class ServerPool(ExtendedApiResource):
+    """ Connections of the RethinkDB pool in this process """
+
+    endpoint = 'admin/pool'
+
+    @decorate.apimethod
+    @auth_token_required
+    @roles_required(config.ROLE_ADMIN)
+    def get(self):
+        # Only where RethinkDB is available
+        from .services.rethink import get_pool
+        return self.response(get_pool().stats())
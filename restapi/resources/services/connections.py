@@ -2,6 +2,8 @@
 
 # i want this piece of code to be the ABSTRACT base of other subclasses
 import abc
+import time
+import threading
 from ... import get_logger
 
 logger = get_logger(__name__)
@@ -95,5 +97,148 @@ class Connection(Borg):
         self._connection = self.make_connection(use_database)
         return self._connection
 
+
+"""
+# === Pool of connections ===
+
+The Borg gives one connection to the whole process:
+with threaded workers every request would share the same socket.
+A bounded pool lets each request thread borrow its own connection.
+"""
+
+
+class PoolTimeout(Exception):
+    """ No connection was released in time """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A bounded and thread-safe pool of connections.
+
+    The pool only needs a 'factory' (a callable returning a new connection);
+    connections are validated with 'check_open' at checkout time
+    and closed if they stay idle for more than 'max_idle' seconds.
+    """
+
+    def __init__(self, factory, max_size=10, max_idle=300, timeout=30):
+        super(ConnectionPool, self).__init__()
+        self._factory = factory
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        # list of (connection, last time it was released)
+        self._idle = []
+        self._in_use = set()
+        self._lock = threading.Condition(threading.Lock())
+        self._stats = {'created': 0, 'evicted': 0, 'waiting': 0}
+
+    @staticmethod
+    def is_healthy(connection):
+        """ Drivers usually tell if the socket is still open """
+        if hasattr(connection, 'is_open'):
+            try:
+                return connection.is_open()
+            except Exception:
+                return False
+        return True
+
+    @staticmethod
+    def close(connection):
+        try:
+            connection.close()
+        except Exception as e:
+            logger.debug("Failed to close connection: %s" % e)
+
+    def _evict(self, now):
+        """ Remove idle connections which are too old. Lock is held. """
+        fresh = []
+        for connection, released in self._idle:
+            if now - released > self.max_idle:
+                self.close(connection)
+                self._stats['evicted'] += 1
+            else:
+                fresh.append((connection, released))
+        self._idle = fresh
+
+    def checkout(self):
+        """ Borrow a connection: reuse an idle one, or open a new one """
+
+        deadline = time.time() + self.timeout
+        with self._lock:
+            while True:
+                self._evict(time.time())
+
+                # Most recently used first: it is the most likely alive
+                while self._idle:
+                    connection, _ = self._idle.pop()
+                    if self.is_healthy(connection):
+                        self._in_use.add(connection)
+                        return connection
+                    self.close(connection)
+                    self._stats['evicted'] += 1
+
+                if len(self._in_use) < self.max_size:
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        "No free connection after %s seconds" % self.timeout)
+                self._stats['waiting'] += 1
+                try:
+                    self._lock.wait(remaining)
+                finally:
+                    self._stats['waiting'] -= 1
+
+            # Reserve the slot before releasing the lock to connect
+            placeholder = object()
+            self._in_use.add(placeholder)
+
+        try:
+            connection = self._factory()
+        except Exception:
+            with self._lock:
+                self._in_use.discard(placeholder)
+                self._lock.notify()
+            raise
+
+        with self._lock:
+            self._in_use.discard(placeholder)
+            self._in_use.add(connection)
+            self._stats['created'] += 1
+        logger.debug("Pool: opened a new connection")
+        return connection
+
+    def checkin(self, connection):
+        """ Give a connection back to the pool """
+        with self._lock:
+            if connection not in self._in_use:
+                logger.warning("Pool: releasing an unknown connection")
+                return False
+            self._in_use.discard(connection)
+            if self.is_healthy(connection):
+                self._idle.append((connection, time.time()))
+            else:
+                self.close(connection)
+                self._stats['evicted'] += 1
+            self._lock.notify()
+        return True
+
+    def stats(self):
+        """ Numbers to know how the pool is behaving """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_use'] = len(self._in_use)
+            stats['idle'] = len(self._idle)
+            stats['max_size'] = self.max_size
+        return stats
+
+    def close_all(self):
+        with self._lock:
+            for connection, _ in self._idle:
+                self.close(connection)
+            self._idle = []
+
 # === How to verify one object ===
 # print Connection().get_connection() #2times
@@ -17,9 +17,19 @@ http://elasticsearch-dsl.readthedocs.io/en/latest/search_dsl.html?highlight=aggr
 
 """
 
+import os
+import re
+import time
+import copy
+import json
+import threading
+from contextlib import contextmanager
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan, parallel_bulk
 # from beeprint import pp
 from ... import get_logger
+from ...timing import timed
+from ...cache import LocalCache
 
 logger = get_logger(__name__)
 
@@ -28,7 +38,35 @@ ES_SERVICE = {
     "host": ES_SERVER, "port": 9200,
     # 'http_auth': ('elastic', 'changeme')
 }
-EL_INDEX0 = "split_html"
+# One client per process: keep-alive connections, retries and sniffing
+ES_CLIENT_OPTIONS = {
+    # connections kept open for each node
+    'maxsize': int(os.environ.get('ES_MAXSIZE', 25)),
+    'timeout': int(os.environ.get('ES_TIMEOUT', 10)),
+    'max_retries': int(os.environ.get('ES_RETRIES', 3)),
+    'retry_on_timeout': True,
+    # discover the other nodes of the cluster, if any
+    # (e.g. ES_SNIFF=1; '0' or 'false' keep it disabled)
+    'sniff_on_connection_fail':
+        os.environ.get('ES_SNIFF', '').strip().lower()
+        in ('1', 'true', 'yes', 'on'),
+}
+# Seconds between two background pings
+ES_HEALTH_INTERVAL = int(os.environ.get('ES_HEALTH_INTERVAL', 15))
+# Cache of search results (timeouts in seconds, 0 to disable)
+ES_CACHE_SIZE = int(os.environ.get('ES_CACHE_SIZE', 2048))
+ES_CACHE_TIMEOUT = int(os.environ.get('ES_CACHE_TIMEOUT', 300))
+ES_CACHE_NEGATIVE_TIMEOUT = int(os.environ.get('ES_CACHE_NEGATIVE', 30))
+# Term lookups: documents per round trip, and how long a scroll lives
+ES_SCROLL_SIZE = int(os.environ.get('ES_SCROLL_SIZE', 500))
+ES_SCROLL_TIME = os.environ.get('ES_SCROLL_TIME', '1m')
+# Bulk indexing: a request is sent every N actions or bytes (the first
+# limit reached), and up to 'threads' requests travel together
+ES_BULK_SIZE = int(os.environ.get('ES_BULK_SIZE', 1000))
+ES_BULK_BYTES = int(os.environ.get('ES_BULK_BYTES', 5 * 1024 * 1024))
+ES_BULK_THREADS = int(os.environ.get('ES_BULK_THREADS', 4))
+# Rebuilds create new indices behind the aliases: old ones kept for rollback
+ES_KEEP_GENERATIONS = int(os.environ.get('ES_KEEP_GENERATIONS', 2))
 EL_INDEX1 = "catalogue"
 EL_INDEX2 = "suggestions"
 EL_INDEX3 = "lexique"
@@ -76,36 +114,97 @@ BASE_SETTINGS = {
     }
 }
 
-HTML_ANALYZER = {
-    "settings": {
-        "analysis": {
-            "analyzer": {
-                "my_html_analyzer": {
-                    "tokenizer": "standard",
-                    "char_filter": ["html_strip"]
-                }
-            }
-        }
-    }
-}
-# https://www.elastic.co/guide/en/elasticsearch/reference/current/analysis-htmlstrip-charfilter.html
-#     "settings": {
-#         "analysis": {
-#             "analyzer": {
-#                 "my_html_analyzer": {
-#                     "tokenizer": "keyword",
-#                     "char_filter": ["my_char_filter"]
-#                 }
-#             },
-#             "char_filter": {
-#                 "my_char_filter": {
-#                     "type": "html_strip",
-#                     # "escaped_tags": ["b"]
-#                 }
-#             }
-#         }
-#     }
-# }
+
+# ######################################
+#
+# # Shared client
+#
+# ######################################
+_client = None
+_client_lock = threading.Lock()
+# Unknown at startup: optimistic until the first check
+es_healthy = threading.Event()
+es_healthy.set()
+
+
+# ######################################
+#
+# # Search results cache
+#
+# ######################################
+search_cache = LocalCache(max_size=ES_CACHE_SIZE, timeout=ES_CACHE_TIMEOUT)
+# What identifies the concrete indices behind each name
+_signatures = {}
+
+
+def bump_generation(index=EL_INDEX1):
+    """ Invalidate all cached results of an index, at once """
+    return search_cache.incr('generation:' + index)
+
+
+def check_generations(client, indexes=(EL_INDEX1, EL_INDEX2)):
+    """
+    A rebuild (maybe from another process) creates new indices,
+    and the sync worker writes documents:
+    uuids and indexing counters tell us that cached results are old.
+    """
+    for index in indexes:
+        try:
+            settings = client.indices.get_settings(index=index)
+            stats = client.indices.stats(index=index, metric='indexing')
+        except Exception:
+            continue
+        signature = []
+        for name, value in settings.items():
+            indexing = stats['indices'].get(name, {}) \
+                .get('primaries', {}).get('indexing', {})
+            signature.append((
+                name, value['settings']['index'].get('uuid'),
+                indexing.get('index_total'), indexing.get('delete_total')))
+        signature.sort()
+        previous = _signatures.get(index)
+        _signatures[index] = signature
+        if previous is not None and previous != signature:
+            logger.debug("Index '%s' has changed" % index)
+            bump_generation(index)
+
+
+def check_health(client, interval=ES_HEALTH_INTERVAL):
+    """ Ping in background, so requests never wait for it """
+    while True:
+        try:
+            alive = client.ping()
+        except Exception as e:
+            logger.debug("Elasticsearch ping failed: %s" % e)
+            alive = False
+        if alive:
+            if not es_healthy.is_set():
+                logger.info("Elasticsearch is reachable again")
+            es_healthy.set()
+            check_generations(client)
+        else:
+            if es_healthy.is_set():
+                logger.critical("Elasticsearch is not reachable")
+            es_healthy.clear()
+        time.sleep(interval)
+
+
+def get_client():
+    """ The Elasticsearch client is thread safe: share one per process """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                options = dict(ES_SERVICE)
+                options.update(ES_CLIENT_OPTIONS)
+                client = Elasticsearch(**options)
+                checker = threading.Thread(
+                    target=check_health, args=(client,), name='es-health')
+                checker.daemon = True
+                checker.start()
+                _client = client
+                logger.info("Connected to Elasticsearch")
+    return _client
 
 
 # ######################################
@@ -119,36 +218,123 @@ class FastSearch(object):
     """
 
     def get_instance(self):
-        self._api = Elasticsearch(**ES_SERVICE)
-        logger.info("Connected to Elasticsearch")
-        try:
-            self._api.ping()
-        except Exception as e:
-            logger.critical("Elasticsearch connection failed:\n'%s'" % e)
+        self._api = get_client()
+        if not es_healthy.is_set():
+            logger.critical("Elasticsearch connection failed")
             return False
         return self
 
-    def fast_query(self, field, value):
+    def cached_search(self, args):
+        """
+        Same search arguments, same results: until they expire
+        or the generation of the index changes (updates and rebuilds).
+        Empty results are kept for a shorter time.
+        """
+        index = args['index']
+        key = '%s:%s:%s' % (
+            index, search_cache.counter('generation:' + index),
+            json.dumps(args, sort_keys=True, default=str))
+
+        out = search_cache.get(key)
+        if out is not None:
+            # Callers may change the hits they receive
+            return copy.deepcopy(out)
 
-        if not self.get_instance():
-            return []
+        out = self._api.search(**args)
+        timeout = None
+        if out['hits']['total'] == 0:
+            if ES_CACHE_NEGATIVE_TIMEOUT < 1:
+                return out
+            timeout = ES_CACHE_NEGATIVE_TIMEOUT
+        if ES_CACHE_TIMEOUT > 0:
+            search_cache.set(key, copy.deepcopy(out), timeout=timeout)
+        return out
+
+    @staticmethod
+    def term_query(field, value):
+        return {"query": {"bool": {"must": [
+                {"term": {field: {"value": value}}}]}}}
+
+    def stream_query(self, field, value, fields=None, size=ES_SCROLL_SIZE):
+        """
+        All the documents with a term, as a generator:
+        only 'size' hits at a time are in memory, here and inside ES.
+        'fields' restricts the '_source' to the ones the caller needs.
+        Failures in the middle are raised: the result would be partial.
+        """
 
-        args = {'index': EL_INDEX1, 'doc_type': EL_TYPE1, 'size': 10000}
-        args['body'] = {"query": {"bool": {"must": [
-                        {"term": {field: {"value": value}}}]}}}
-        # pp(args)
+        if not self.get_instance():
+            return
+        args = {'index': EL_INDEX1, 'doc_type': EL_TYPE1,
+                'query': self.term_query(field, value),
+                'size': size, 'scroll': ES_SCROLL_TIME}
+        if fields is not None:
+            args['_source'] = fields
         try:
-            out = self._api.search(**args)
+            for hit in scan(self._api, **args):
+                yield hit
         except Exception as e:
-            logger.error("Failed to execute fast get query\n%s" % e)
+            logger.error("Failed to stream query on %s\n%s" % (field, e))
+            raise
+
+    @timed('es.fast_query')
+    def fast_query(self, field, value, fields=None):
+        """ Kept for callers wanting a list: prefer 'stream_query' """
+        try:
+            return list(self.stream_query(field, value, fields=fields))
+        except Exception:
+            # As before: never a truncated list
             return None, False
-        # pp(out)
-        return out['hits']['hits']
 
+    @timed('es.fast_query_page')
+    def fast_query_page(self, field, value,
+                        size=ES_SCROLL_SIZE, cursor=None, fields=None):
+        """
+        One page of a term lookup, for paginated REST responses.
+        The cursor is the scroll of the previous page:
+        it is None when there is nothing more to read.
+        """
+
+        if not self.get_instance():
+            return [], None
+
+        try:
+            if cursor is None:
+                args = {'index': EL_INDEX1, 'doc_type': EL_TYPE1,
+                        'body': self.term_query(field, value),
+                        'size': size, 'scroll': ES_SCROLL_TIME,
+                        # the order of documents is not needed
+                        'sort': '_doc'}
+                if fields is not None:
+                    args['_source'] = fields
+                out = self._api.search(**args)
+            else:
+                out = self._api.scroll(
+                    scroll_id=cursor, scroll=ES_SCROLL_TIME)
+        except Exception as e:
+            logger.error("Failed to execute fast query page\n%s" % e)
+            return [], None
+
+        hits = out['hits']['hits']
+        scroll_id = out.get('_scroll_id')
+        if len(hits) < size:
+            # Last page: free the scroll right now
+            if scroll_id is not None:
+                try:
+                    self._api.clear_scroll(scroll_id=scroll_id)
+                except Exception as e:
+                    logger.debug("Failed to clear scroll: %s" % e)
+            scroll_id = None
+        return hits, scroll_id
+
+    @timed('es.fast_get_all')
     def fast_get_all(
         self, keyword, size=5, index=EL_INDEX3, type=EL_TYPE1, category=False
     ):
 
+        if not self.get_instance():
+            return None, False
+
         args = {'index': index, 'doc_type': type}
         args['from_'] = 0
         args['size'] = size
@@ -186,6 +372,7 @@ class FastSearch(object):
         # pp(out)
         return out['hits']['hits'], out['hits']['total']
 
+    @timed('es.fast_id')
     def fast_id(self, id):
 
         if not self.get_instance():
@@ -197,13 +384,20 @@ class FastSearch(object):
             logger.error("Failed to execute fast get query\n%s" % e)
         return [out]
 
+    @timed('es.fast_get')
     def fast_get(self, keyword, current=1, size=10, filters={}):
 
+        if not self.get_instance():
+            return None, False
+
         args = {'index': EL_INDEX1, 'doc_type': EL_TYPE1}
         args['sort'] = ["sort_number:asc"]
         # args['sort'] = ["sort_string:asc", "sort_number:asc"]
         args['from_'] = current - 1
         args['size'] = size
+        if keyword is not None:
+            # Same results for the same words
+            keyword = ' '.join(keyword.split())
 
         if keyword is not None or len(filters) > 0:
             args['body'] = {
@@ -257,17 +451,22 @@ class FastSearch(object):
         # pp(args)
 
         try:
-            out = self._api.search(**args)
+            out = self.cached_search(args)
         except Exception as e:
             logger.error("Failed to execute fast get query\n%s" % e)
             return None, False
         # print(out)
         return out['hits']['hits'], out['hits']['total']
 
+    @timed('es.fast_suggest')
     def fast_suggest(self, text):
 
         if text is None or text.strip() == '':
             return []
+        if not self.get_instance():
+            return []
+        # Autocomplete: same prefix, same results
+        text = ' '.join(text.lower().split())
 
         obj = {"query": {
             "function_score": {
@@ -282,10 +481,11 @@ class FastSearch(object):
                 ]
             }}}
         args = {'index': EL_INDEX2, 'body': obj}
-        out = self._api.search(**args)
+        out = self.cached_search(args)
         # print("TEST", out)
         return out['hits']['hits']
 
+    @timed('es.fast_update')
     def fast_update(self, id, data, image=False):
 
         if not self.get_instance():
@@ -302,6 +502,7 @@ class FastSearch(object):
 
         try:
             self._api.update(**args)
+            bump_generation(EL_INDEX1)
             logger.info("Updated search %s" % id)
         except Exception as e:
             logger.error("Failed to execute fast update %s\n%s" % (id, e))
@@ -309,6 +510,7 @@ class FastSearch(object):
 
         return True
 
+    @timed('es.fast_remove')
     def fast_remove(self, id):
 
         if not self.get_instance():
@@ -325,5 +527,221 @@ class FastSearch(object):
         except Exception as e:
             logger.error("Failed to execute fast delete %s\n%s" % (id, e))
             return False
+        bump_generation(EL_INDEX1)
 
         return True
+
+
+# ######################################
+#
+# # Bulk indexing
+#
+# ######################################
+class BulkIndexer(object):
+    """
+    Buffer index actions, then send them with parallel bulk requests.
+    Failed documents are reported for each flush, never raised.
+    """
+
+    def __init__(self, client,
+                 size=ES_BULK_SIZE, max_bytes=ES_BULK_BYTES,
+                 threads=ES_BULK_THREADS):
+        super(BulkIndexer, self).__init__()
+        self._api = client
+        self.size = size
+        self.max_bytes = max_bytes
+        self.threads = threads
+        self._actions = []
+        self._bytes = 0
+        self.indexed = 0
+        self.failed = 0
+        self.batches = 0
+
+    def add(self, index, doc_type, body, id=None):
+        action = {'_index': index, '_type': doc_type, '_source': body}
+        if id is not None:
+            action['_id'] = id
+        self.append(action, len(json.dumps(body, default=str)))
+
+    def delete(self, index, doc_type, id):
+        self.append({'_op_type': 'delete',
+                     '_index': index, '_type': doc_type, '_id': id})
+
+    def append(self, action, size=0):
+        self._actions.append(action)
+        self._bytes += size
+        # Each thread gets a full request to send
+        if len(self._actions) >= self.size * self.threads \
+           or self._bytes >= self.max_bytes * self.threads:
+            self.flush()
+
+    @timed('es.bulk')
+    def flush(self):
+        if len(self._actions) < 1:
+            return 0
+        actions = self._actions
+        self._actions = []
+        self._bytes = 0
+        self.batches += 1
+
+        errors = []
+        for ok, info in parallel_bulk(
+            self._api, actions,
+            thread_count=self.threads, chunk_size=self.size,
+            max_chunk_bytes=self.max_bytes,
+            raise_on_error=False, raise_on_exception=False
+        ):
+            if ok:
+                self.indexed += 1
+            elif info.get('delete', {}).get('status') == 404:
+                # Already gone
+                self.indexed += 1
+            else:
+                errors.append(info)
+
+        self.failed += len(errors)
+        if len(errors) > 0:
+            logger.error("Bulk batch %s: %s/%s documents failed, e.g. %s"
+                         % (self.batches, len(errors), len(actions),
+                            errors[0]))
+        else:
+            logger.debug("Bulk batch %s: %s documents"
+                         % (self.batches, len(actions)))
+        return len(actions) - len(errors)
+
+    def close(self):
+        self.flush()
+        logger.info("Bulk indexing: %s documents, %s failed, %s batches"
+                    % (self.indexed, self.failed, self.batches))
+        return self.failed == 0
+
+
+@contextmanager
+def bulk_build(client, *indexes):
+    """
+    While building the indexes: no refresh and no replicas.
+    The previous settings come back at the end, even on errors.
+    """
+
+    previous = {}
+    for index in indexes:
+        settings = client.indices.get_settings(index=index)
+        for name, value in settings.items():
+            current = value['settings']['index']
+            previous[name] = {
+                'refresh_interval': current.get('refresh_interval', '1s'),
+                'number_of_replicas': current.get('number_of_replicas', 1),
+            }
+        client.indices.put_settings(index=index, body={'index': {
+            'refresh_interval': '-1', 'number_of_replicas': 0}})
+    try:
+        yield client
+    finally:
+        for name, settings in previous.items():
+            client.indices.put_settings(index=name, body={'index': settings})
+            client.indices.refresh(index=name)
+            logger.debug("Restored settings of index '%s'" % name)
+
+
+# ######################################
+#
+# # Versioned indices
+#
+# ######################################
+def versioned_name(alias, version=None):
+    """ e.g. 'catalogue_v1500000000' """
+    if version is None:
+        version = int(time.time())
+    return '%s_v%s' % (alias, version)
+
+
+def index_generations(client, alias):
+    """ Concrete indices built for an alias, oldest first """
+    pattern = re.compile(r'^%s_v([0-9]+)$' % re.escape(alias))
+    names = []
+    for name in client.indices.get_settings(index='%s_v*' % alias):
+        match = pattern.match(name)
+        if match is not None:
+            names.append((int(match.group(1)), name))
+    return [name for _, name in sorted(names)]
+
+
+def create_versioned(client, alias, body=None, version=None):
+    """ A new index for 'alias': searches do not see it until the swap """
+    name = versioned_name(alias, version)
+    client.indices.create(index=name, body=body or {})
+    logger.info("Created index %s (for alias '%s')" % (name, alias))
+    return name
+
+
+def swap_alias(client, alias, index, keep=ES_KEEP_GENERATIONS):
+    """ Point 'alias' to 'index' (see swap_aliases) """
+    swap_aliases(client, {alias: index}, keep)
+    return index
+
+
+def swap_aliases(client, indexes, keep=ES_KEEP_GENERATIONS):
+    """
+    Point each alias to its new index ({alias: index})
+    with one atomic request, then remove the generations
+    beyond the last 'keep' old ones.
+    """
+
+    actions = []
+    for alias, index in sorted(indexes.items()):
+        if client.indices.exists(index=alias) \
+           and not client.indices.exists_alias(name=alias):
+            # Built before versioning: a real index holds the alias name
+            client.indices.delete(index=alias)
+            logger.warning(
+                "Removed index '%s' to use it as an alias" % alias)
+
+        if client.indices.exists_alias(name=alias):
+            for name in client.indices.get_alias(name=alias):
+                actions.append({'remove': {'index': name, 'alias': alias}})
+        actions.append({'add': {'index': index, 'alias': alias}})
+    client.indices.update_aliases(body={'actions': actions})
+
+    for alias, index in sorted(indexes.items()):
+        logger.info("Alias '%s' now points to %s" % (alias, index))
+        old = [name for name in index_generations(client, alias)
+               if name != index]
+        if keep > 0:
+            old = old[:-keep]
+        for name in old:
+            client.indices.delete(index=name)
+            logger.debug("Removed old generation %s" % name)
+        bump_generation(alias)
+
+    return indexes
+
+
+def drop_versioned(client, *indices):
+    """ Generations never put behind their alias (e.g. a failed build) """
+    for name in indices:
+        # Never an index already searched
+        if client.indices.exists_alias(index=name):
+            continue
+        client.indices.delete(index=name, ignore=404)
+        logger.warning("Removed unfinished index %s" % name)
+
+
+def rollback_alias(client, alias):
+    """ Back to the generation older than the current one, if any """
+
+    current = list(client.indices.get_alias(name=alias))
+    generations = index_generations(client, alias)
+    positions = [generations.index(name)
+                 for name in current if name in generations]
+    # Newer ones were never completed, or were rolled back already
+    if len(positions) < 1 or min(positions) < 1:
+        logger.error("No old generation of '%s' to roll back to" % alias)
+        return None
+    previous = generations[min(positions) - 1]
+    actions = [{'remove': {'index': name, 'alias': alias}}
+               for name in current]
+    actions.append({'add': {'index': previous, 'alias': alias}})
+    client.indices.update_aliases(body={'actions': actions})
+    bump_generation(alias)
+    logger.info("Alias '%s' rolled back to %s" % (alias, previous))
+    return previous
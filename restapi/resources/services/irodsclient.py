@@ -16,6 +16,7 @@ import inspect
 import re
 from collections import OrderedDict
 from ..basher import BashCommands
+from ...timing import timed
 from confs.config import IRODS_ENV
 
 # from ..templating import Templa
@@ -217,6 +218,7 @@ class ICommands(BashCommands):
 
     ###################
     # Basic command with the GSI plugin
+    @timed('irods.basic_icom')
     def basic_icom(self, com, args=[]):
         """
         Use the current environment variables to be another irods user
@@ -5,17 +5,23 @@
 import os
 import time
 import glob
+import logging
+import threading
 # import commentjson as json
 import json
 
 # This Rethinkdb reference is already connected at app init
-from rethinkdb import r, RqlDriverError
+from rethinkdb import r, RqlDriverError, RqlRuntimeError
+from rethinkdb.net import Repl
 
 from flask import g, request  # , url_for, redirect
-from .connections import Connection
+from .connections import Connection, ConnectionPool
 from ..base import ExtendedApiResource
 from ... import htmlcodes as hcodes
+from ...jsonify import NDJSON_MIMETYPES, STREAM_MIMETYPES, \
+    parse_ndjson, output_stream, RESTError
 from ...marshal import convert_to_marshal
+from ...timing import timed
 from ... import get_logger
 
 # Using docker, "**db**"" is my alias of the ReThinkDB container
@@ -24,13 +30,23 @@ RDB_PORT = 28015
 # Models and paths
 JSONS_PATH = 'models'
 JSONS_EXT = '.json'
+# Inside a model: secondary indexes to create on its table
+INDEXES_KEY = '_indexes'
 # Database and tables to use
 APP_DB = "webapp"
 DEFAULT_TABLE = "test"
+PRIMARY_KEY = 'id'
 ACTION_COLUMN = 'operation'
 TIME_COLUMN = 'timestamp'
 IP_COLUMN = 'ipaddress'
 USER_COLUMN = 'latest_user'
+LOGS_COLUMN = 'logs'
+# Pool of connections used by request threads
+RDB_POOL_SIZE = int(os.environ.get('RDB_POOL_SIZE', 10))
+RDB_POOL_MAX_IDLE = int(os.environ.get('RDB_POOL_MAX_IDLE', 300))
+RDB_POOL_TIMEOUT = int(os.environ.get('RDB_POOL_TIMEOUT', 30))
+# How many documents for each insert in batch mode
+RDB_BULK_SIZE = int(os.environ.get('RDB_BULK_SIZE', 500))
 
 logger = get_logger(__name__)
 
@@ -56,7 +72,8 @@ class RethinkConnection(Connection):
     """
     Connection for ReThinkDB.
     Based on the Borg design pattern, to optimize resources on
-    opening connections for each request processed by Flask
+    opening connections for scripts and operations.
+    Requests processed by Flask borrow from the pool instead (get_pool).
     """
 
     def __init__(self, load_setup=False):
@@ -76,19 +93,11 @@ class RethinkConnection(Connection):
         after starting it up, using ssh from app container.
         Expecting the environment variable to contain a key.
         """
-        params = {"host": RDB_HOST, "port": RDB_PORT}
-        key = os.environ.get('KEYDBPASS') or None
-        if key is not None:
-            params["auth_key"] = key
-            logger.info("Connection is pw protected")
-        # else:
-        #     logger.warning("Using no authentication")
-
         # Rethinkdb database connection
         try:
             # IMPORTANT! The chosen ORM library does not work if missing repl()
             # at connection time
-            self._connection = r.connect(**params).repl()
+            self._connection = r.connect(**connection_params()).repl()
             logger.debug("Created Connection")
         except RqlDriverError as e:
             logger.critical("Failed to connect RDB", e)
@@ -107,12 +116,414 @@ class RethinkConnection(Connection):
             logger.debug("Table '" + table + "' already exists.")
             if remove_existing:
                 r.table_drop(table).run()
+                tables_catalog.remove(APP_DB, table)
                 logger.info("Removed")
         else:
             r.table_create(table).run()
+            tables_catalog.add(APP_DB, table)
             logger.info("Table '" + table + "' created")
 
 
+def connection_params():
+    """ Where and how to connect """
+    params = {"host": RDB_HOST, "port": RDB_PORT}
+    key = os.environ.get('KEYDBPASS') or None
+    if key is not None:
+        params["auth_key"] = key
+        logger.info("Connection is pw protected")
+    # else:
+    #     logger.warning("Using no authentication")
+    return params
+
+
+def new_pooled_connection():
+    """ Factory for the pool: a connection already using the app db """
+    return r.connect(db=APP_DB, **connection_params())
+
+
+_pool = None
+
+
+def get_pool():
+    """ One pool per process, created at first use """
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(
+            new_pooled_connection, max_size=RDB_POOL_SIZE,
+            max_idle=RDB_POOL_MAX_IDLE, timeout=RDB_POOL_TIMEOUT)
+        logger.info("Created RDB pool of %s connections" % RDB_POOL_SIZE)
+    return _pool
+
+
+##########################################
+# Tables catalog
+class TablesCatalog(object):
+    """
+    Per process cache of the existing tables, for each database.
+
+    Filled once from the server, updated when this process creates
+    or drops a table, and kept in sync with the other workers
+    through a changefeed on the 'table_config' system table.
+    """
+
+    def __init__(self):
+        super(TablesCatalog, self).__init__()
+        self._tables = {}
+        self._lock = threading.Lock()
+        self._feed = None
+
+    def load(self, db, connection=None):
+        """ Ask the server only once """
+        tables = set(r.db(db).table_list().run(connection))
+        with self._lock:
+            self._tables[db] = tables
+        logger.debug("Catalog of '%s': %s tables" % (db, len(tables)))
+        return tables
+
+    def exists(self, db, table, connection=None):
+        """ Background threads have no 'repl': they give a connection """
+        tables = self._tables.get(db)
+        if tables is None:
+            tables = self.load(db, connection)
+        return table in tables
+
+    def add(self, db, table):
+        with self._lock:
+            if db in self._tables:
+                self._tables[db].add(table)
+
+    def remove(self, db, table):
+        with self._lock:
+            if db in self._tables:
+                self._tables[db].discard(table)
+
+    def clear(self):
+        """ Forget everything: next lookups will reload from the server """
+        with self._lock:
+            self._tables = {}
+
+    def apply_change(self, change):
+        """ A single changefeed notification from 'table_config' """
+        old = change.get('old_val')
+        new = change.get('new_val')
+        if old is not None:
+            self.remove(old['db'], old['name'])
+        if new is not None:
+            self.add(new['db'], new['name'])
+
+    def follow_changes(self, db):
+        """ Listen to DDL from any worker; reconnect on failures """
+        sleep_time = 1
+        while True:
+            connection = None
+            try:
+                connection = new_pooled_connection()
+                feed = r.db('rethinkdb').table('table_config').changes()
+                cursor = feed.run(connection)
+                # The feed is active: a full load now cannot miss any DDL
+                for known in set(self._tables) | set([db]):
+                    self.load(known, connection)
+                sleep_time = 1
+                for change in cursor:
+                    self.apply_change(change)
+            except (RqlDriverError, RqlRuntimeError) as e:
+                logger.warning("Tables changefeed interrupted: %s" % e)
+            finally:
+                if connection is not None:
+                    ConnectionPool.close(connection)
+            # Changes may be lost while disconnected
+            self.clear()
+            time.sleep(sleep_time)
+            sleep_time = min(sleep_time * 2, 60)
+
+    def watch(self, db=APP_DB):
+        """ Load the catalog at startup and keep it updated in background """
+        if self._feed is not None:
+            return False
+        self._feed = threading.Thread(
+            target=self.follow_changes, args=(db,), name='rdb-tables-feed')
+        self._feed.daemon = True
+        self._feed.start()
+        return True
+
+
+tables_catalog = TablesCatalog()
+
+
+##########################################
+# Secondary indexes
+class IndexManager(object):
+    """
+    Secondary indexes declared inside JSON models.
+
+    Inside a model, the '_indexes' object maps the index name to:
+    - "field": a simple index on a field
+    - ["field1", "field2"]: a compound index
+    - {"fields": ..., "multi": true}: a multi index
+    - {"path": ["steps", "data", "value"], "multi": true}:
+        function based, on a nested path of the document;
+        with "multi", arrays along the path are flattened
+        and every single value is indexed
+    """
+
+    def __init__(self):
+        super(IndexManager, self).__init__()
+        self._declared = {}
+        self._ready = {}
+        # Plain fields of each model
+        self._fields = {}
+        self._lock = threading.Lock()
+
+    def declare_fields(self, table, fields):
+        self._fields.setdefault(table, set()).update(fields)
+
+    def is_field(self, table, name):
+        """ A field of the model, not an index name """
+        return name in self._fields.get(table, ()) and \
+            name not in self._declared.get(table, {})
+
+    def declare(self, table, indexes):
+        if not isinstance(indexes, dict):
+            logger.warning("Invalid indexes for table '%s'" % table)
+            return False
+        self._declared.setdefault(table, {}).update(indexes)
+        return True
+
+    @staticmethod
+    def parse(definition):
+        """ From the JSON definition to (function, options, fields) """
+        options = {}
+        if isinstance(definition, dict):
+            options['multi'] = definition.get('multi', False)
+            if 'path' in definition:
+                path = definition['path']
+
+                def function(doc):
+                    for step in path:
+                        doc = doc[step]
+                    return doc
+
+                def flat_function(doc):
+                    values = r.expr([doc])
+                    for step in path:
+                        values = values.concat_map(
+                            lambda element: r.branch(
+                                element[step].type_of() == 'ARRAY',
+                                element[step], [element[step]]))
+                    return values
+
+                if options['multi']:
+                    return flat_function, options, None
+                return function, options, None
+            definition = definition.get('fields')
+
+        if isinstance(definition, list):
+            fields = definition
+            return [r.row[field] for field in fields], options, fields
+        return r.row[definition], options, [definition]
+
+    def fields(self, table, name):
+        """ Plain fields covered by an index (None if function based) """
+        definition = self._declared.get(table, {}).get(name)
+        if definition is None:
+            return None
+        return self.parse(definition)[2]
+
+    def create_missing(self, table, db=APP_DB, connection=None):
+        """ Diff the declared indexes with 'index_list' """
+        query = r.db(db).table(table)
+        existing = query.index_list().run(connection)
+        created = []
+        for name, definition in self._declared.get(table, {}).items():
+            if name in existing:
+                continue
+            function, options, _ = self.parse(definition)
+            try:
+                query.index_create(name, function, **options).run(connection)
+                created.append(name)
+                logger.info("Creating index '%s' on '%s'" % (name, table))
+            except RqlRuntimeError as e:
+                # Another worker may have been faster
+                logger.debug("Index '%s' not created: %s" % (name, e))
+        return created
+
+    def sync(self, db=APP_DB):
+        """ Create missing indexes and wait for all of them """
+        connection = None
+        try:
+            connection = new_pooled_connection()
+            for table in list(self._declared):
+                if not tables_catalog.exists(db, table, connection):
+                    try:
+                        r.db(db).table_create(table).run(connection)
+                    except RqlRuntimeError:
+                        pass
+                    tables_catalog.add(db, table)
+                self.create_missing(table, db, connection)
+                r.db(db).table(table).index_wait().run(connection)
+                with self._lock:
+                    self._ready[table] = set(self._declared[table])
+                logger.info("Indexes ready on '%s': %s"
+                            % (table, sorted(self._ready[table])))
+        except (RqlDriverError, RqlRuntimeError) as e:
+            logger.error("Failed to sync indexes: %s" % e)
+            return False
+        finally:
+            if connection is not None:
+                ConnectionPool.close(connection)
+        return True
+
+    def sync_until_ready(self, db=APP_DB):
+        """ Try again (waiting more every time) until it works """
+        sleep_time = 1
+        while not self.sync(db):
+            time.sleep(sleep_time)
+            sleep_time = min(sleep_time * 2, 60)
+
+    def sync_in_background(self, db=APP_DB):
+        worker = threading.Thread(
+            target=self.sync_until_ready, args=(db,), name='rdb-indexes')
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def is_ready(self, table, name):
+        return name in self._ready.get(table, ())
+
+    def status(self):
+        """ For each table: declared indexes and if they are usable """
+        return dict(
+            (table, dict((name, self.is_ready(table, name))
+                         for name in indexes))
+            for table, indexes in self._declared.items())
+
+    def find(self, table, field):
+        """ A ready index to look for a single field, if any """
+        for name in self._ready.get(table, ()):
+            if self.fields(table, name) == [field]:
+                return name
+        return None
+
+
+index_manager = IndexManager()
+
+
+##########################################
+# Changefeeds on tables
+class TableWatcher(threading.Thread):
+    """
+    Call back at every change of a table, from a background thread.
+    Callbacks receive None when the feed starts or breaks:
+    changes in that moment could be lost.
+    """
+
+    def __init__(self, table, db=APP_DB):
+        super(TableWatcher, self).__init__(name='rdb-watch-' + table)
+        self.daemon = True
+        self.table = table
+        self.db = db
+        # Set only while subscribed
+        self.ready = threading.Event()
+
+    def notify(self, change):
+        with _watchers_lock:
+            callbacks = list(_callbacks.get(self.table, {}).values())
+        for callback in callbacks:
+            callback(change)
+
+    def run(self):
+        connection = None
+        try:
+            connection = new_pooled_connection()
+            cursor = r.db(self.db).table(self.table).changes() \
+                .run(connection)
+            self.ready.set()
+            self.notify(None)
+            for change in cursor:
+                self.notify(change)
+        except (RqlDriverError, RqlRuntimeError) as e:
+            logger.warning("Changefeed on '%s' interrupted: %s"
+                           % (self.table, e))
+        finally:
+            if connection is not None:
+                ConnectionPool.close(connection)
+        self.ready.clear()
+        self.notify(None)
+
+
+_watchers = {}
+# Callbacks of each table, by name: they survive a broken feed
+_callbacks = {}
+_watchers_lock = threading.Lock()
+
+
+def watch_table(table, callback, db=APP_DB, name=None):
+    """
+    Make sure a changefeed is following the table,
+    calling back once for each name.
+    Returns True only if the feed is already subscribed.
+    """
+    with _watchers_lock:
+        _callbacks.setdefault(table, {}).setdefault(name, callback)
+        watcher = _watchers.get(table)
+        if watcher is None or not watcher.is_alive():
+            watcher = TableWatcher(table, db)
+            watcher.start()
+            _watchers[table] = watcher
+    return watcher.ready.is_set()
+
+
+##########################################
+# Versions of tables
+class TableVersions(object):
+    """
+    The version of each table followed by a changefeed.
+
+    It comes from the data (see 'version_query'), so all the workers
+    give the same ETags; it is computed again only after a change,
+    otherwise the cached one is used.
+    The feed also tells when the latest change happened:
+    when it starts or breaks, as changes may have been lost.
+    """
+
+    def __init__(self):
+        super(TableVersions, self).__init__()
+        # table -> (changes seen, time of the latest one)
+        self._changes = {}
+        # table -> (changes seen when computed, version)
+        self._cached = {}
+        self._lock = threading.Lock()
+
+    def bump(self, table):
+        with self._lock:
+            changes, _ = self._changes.get(table, (0, 0))
+            self._changes[table] = (changes + 1, time.time())
+
+    def modified(self, table):
+        """ 0 if no change was seen (yet) """
+        with self._lock:
+            return self._changes.get(table, (0, 0))[1]
+
+    def get(self, table, compute, db=APP_DB):
+        """ None until the table is followed """
+        if not watch_table(
+                table, lambda change: self.bump(table), db, name='versions'):
+            return None
+        with self._lock:
+            changes, _ = self._changes.get(table, (0, 0))
+            cached = self._cached.get(table)
+        if cached is not None and cached[0] == changes:
+            return cached[1]
+        # Changes happening meanwhile will make it stale
+        version = compute()
+        with self._lock:
+            self._cached[table] = (changes, version)
+        return version
+
+
+table_versions = TableVersions()
+
+
 def wait_for_connection():
     """ Wait for rethinkdb connection at startup? """
 
@@ -125,9 +536,8 @@ def wait_for_connection():
             rdb = r.connect(host=RDB_HOST, port=RDB_PORT)
             logger.info("Rethinkdb: available")
             testdb = False
-            # Need a pool of connections: http://j.mp/1yNP4p0
-            if g and "rdb" not in g:
-                g.rdb = rdb
+            # Requests will use the pool: see try_to_connect
+            rdb.close()
         except RqlDriverError:
             logger.warning("Rethinkdb: Not reachable yet")
         counter += 1
@@ -140,19 +550,43 @@ def wait_for_connection():
 
 ##########################################
 def try_to_connect():
+    """
+    Borrow a connection from the pool for the current request.
+
+    repl() is bound to the current thread inside the driver,
+    so every '.run()' of this request will use this connection.
+    """
     if g and "rdb" in g:
         return False
     try:
-        logger.debug("Creating the rdb object")
-        rdb = RethinkConnection()
-        # Need a pool of connections: http://j.mp/1yNP4p0
+        logger.debug("Checkout of a rdb connection")
+        rdb = get_pool().checkout()
+        rdb.repl()
         if g:
             g.rdb = rdb
     except Exception as e:
         logger.error("Cannot connect:\n'%s'" % e)
+        # Never go on with the connection of a previous request
+        Repl.clear()
+        if g:
+            raise RESTError(
+                "Problem: no database connection could be established.",
+                status_code=hcodes.HTTP_SERVICE_UNAVAILABLE)
         return None
-        # abort(hcodes.HTTP_INTERNAL_TIMEOUT,
-        #     "Problem: no database connection could be established.")
+    return True
+
+
+def release_connection(exception=None):
+    """ Give back the request connection to the pool """
+    if not g or "rdb" not in g:
+        return False
+    rdb = g.pop("rdb")
+    # This thread must not keep using a connection others will borrow
+    Repl.clear()
+    get_pool().checkin(rdb)
+    # Stats take the pool lock: not for every request
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Pool status: %s", get_pool().stats())
     return True
 
 
@@ -164,28 +598,31 @@ class RDBdefaults(object):
     db = APP_DB
     order = TIME_COLUMN
 
-    def save_action_info(self, document, action='record_creation'):
-
-        if not isinstance(document, dict):
-            logger.warning("The element to insert is not a document")
-            return document
-
-        key = "logs"
+    def action_log(self, action):
+        """ Who did what and when """
 # RECOVER THE USER FROM FLASK!
 # Recover from token? # Somewhere with Flask security
         user = None
         if user is None:
             user = 'UNKNOWN'
 
-        log = {
+        return {
             TIME_COLUMN: time.time(),
             ACTION_COLUMN: action,
             IP_COLUMN: get_ip(),
             USER_COLUMN: user
         }
+
+    def save_action_info(self, document, action='record_creation'):
+
+        if not isinstance(document, dict):
+            logger.warning("The element to insert is not a document")
+            return document
+
+        key = LOGS_COLUMN
         if key not in document:
             document[key] = []
-        document[key].append(log)
+        document[key].append(self.action_log(action))
 
         return document
 
@@ -198,7 +635,14 @@ class RDBquery(RDBdefaults):
     schema = None
     template = None
     table_index = 'id'
+    # A model index on [sort field, 'id']: the primary key breaks ties
     sort_index = None
+    # Set to False for huge tables: no count, only 'has_more'
+    exact_count = True
+    has_more = False
+    # Sort key of the last element returned, for keyset paging
+    last_key = None
+    bulk_size = RDB_BULK_SIZE
 
     def get_query(self):
         return r.db(self.db)
@@ -208,59 +652,215 @@ class RDBquery(RDBdefaults):
             table = self.table
         # Build a base query: starting from default DB from RDBdefaults.
         base = r.db(self.db)
-        # Create
-        if table not in base.table_list().run():
-            base.table_create(table).run()
+        # Create (the catalog avoids asking the server every time)
+        if not tables_catalog.exists(self.db, table):
+            try:
+                base.table_create(table).run()
+            except RqlRuntimeError as e:
+                # Another worker may have created it in the meantime
+                logger.debug("Table '%s' not created: %s" % (table, e))
+            tables_catalog.add(self.db, table)
         # Use the table
         return base.table(table)
 
+    def select(self, field, value=None, low=None, high=None, table=None):
+        """
+        Documents with the field equal to 'value' (or inside low/high).
+        A ready secondary index is used when available,
+        otherwise a (slower) filter does the job, but only on a field
+        of the model: any other name is an index (e.g. created by hand).
+        """
+        if table is None:
+            table = self.table
+        query = self.get_table_query(table)
+        # Primary key and ready indexes can be used by name
+        if field == PRIMARY_KEY or index_manager.is_ready(table, field):
+            name = field
+        else:
+            name = index_manager.find(table, field)
+            if name is None and not index_manager.is_field(table, field):
+                name = field
+
+        if value is not None:
+            if name is not None:
+                return query.get_all(value, index=name)
+            return query.filter(r.row[field] == value)
+
+        if low is None:
+            low = r.minval
+        if high is None:
+            high = r.maxval
+        if name is not None:
+            return query.between(low, high, index=name)
+        return query.filter((r.row[field] >= low) & (r.row[field] < high))
+
     def list_tables(self):
         return list(self.get_query().table_list().run())
 
-    def execute_query(self, query, limit=0, timestamp=False, group=None):
-        count = 0
-        final = {}
+    def version_query(self, table=None):
+        """
+        What changes when the table changes:
+        how many documents and the latest time one of them was logged.
+        """
+        query = self.get_table_query(table)
+        return {
+            'count': query.count(),
+            'last': query.map(
+                lambda doc: doc[LOGS_COLUMN].nth(-1)[TIME_COLUMN].default(0)
+            ).max().default(0),
+        }
 
-        if not query.is_empty().run():
+    def sort_fields(self):
+        """
+        Fields of the sort index, if pages can start from a key:
+        it has to end with the primary key, or ties would be lost
+        """
+        if self.sort_index is None:
+            return None
+        fields = index_manager.fields(self.table, self.sort_index)
+        if fields is None or fields[-1] != PRIMARY_KEY:
+            return None
+        return fields
+
+    def sort_key(self, document, fields):
+        """ The value of the sort index for a document """
+        key = [document.get(field) for field in fields]
+        if len(key) == 1:
+            return key[0]
+        return key
+
+    def get_version(self, table=None, compute=True):
+        """
+        The version cached while a changefeed follows the table,
+        otherwise (only if asked) computed with a query every time
+        """
+        if table is None:
+            table = self.table
 
-            count = query.count().run()
+        def query_version():
+            return r.expr(self.version_query(table)).run()
 
-            if group is not None:
-                query = query.group(group)
-            if limit > 0:
-                query = query.limit(limit)
-            # Note: fix time as i has to be converted if available
-            # in original rethinkdb format
-            if timestamp:
-                data = query.run(time_format='raw')
-            else:
-                data = query.run()
+        version = table_versions.get(table, query_version, self.db)
+        if version is None and compute:
+            version = query_version()
+        return version
 
-            if group is not None:
-                final = dict(data)
-            else:
-                final = list(data)
+    @timed('rdb.execute_query')
+    def execute_query(self, query, limit=0, timestamp=False, group=None,
+                      skip=0, exact_count=None):
+        """
+        Count and data of one page come back in a single round trip.
+
+        Counting a huge table is expensive: without the exact count
+        one more element is fetched, just to know if other pages exist
+        ('has_more'); the count becomes a lower bound.
+        """
+        if exact_count is None:
+            exact_count = self.exact_count
+        # Looking ahead makes sense only on a plain list of documents
+        look_ahead = not exact_count and group is None and limit > 0
+
+        data = query
+        if group is not None:
+            data = data.group(group)
+        if skip > 0:
+            data = data.skip(skip)
+        if limit > 0:
+            data = data.limit(limit + 1 if look_ahead else limit)
+        if group is not None:
+            data = data.ungroup()
+
+        # Note: fix time as i has to be converted if available
+        # in original rethinkdb format
+        options = {}
+        if timestamp:
+            options['time_format'] = 'raw'
+
+        combined = {}
+        # Arrays built on the server have a size limit: not for everything
+        if limit > 0:
+            combined['data'] = data.coerce_to('array')
+        if exact_count:
+            combined['count'] = query.count()
+
+        out = {}
+        if len(combined) > 0:
+            out = r.expr(combined).run(**options)
+
+        if limit > 0:
+            final = out['data']
+        else:
+            # No limit: a cursor, fetching documents in batches
+            final = list(data.run(**options))
+        self.has_more = False
+        if look_ahead and len(final) > limit:
+            final = final[:limit]
+            self.has_more = True
+
+        if exact_count:
+            count = out['count']
+        else:
+            count = skip + len(final) + int(self.has_more)
+
+        if group is not None:
+            final = dict(
+                (element['group'], element['reduction']) for element in final)
 
         return count, final
 
-    def get_content(self, myid=None, limit=10, index='id'):
-        """ For GET method, very simple """
+    def get_content(self, myid=None, limit=10, index='id',
+                    current_page=1, cursor=None):
+        """
+        For GET method, very simple.
+
+        Pages are found with 'skip' (offset), unless a 'sort_index'
+        ending with the primary key is available: then the last key
+        of the previous page (cursor) lets the next page start
+        with 'between', at the cost of one page.
+        """
 
         query = self.get_table_query()
         timestamp = False
+        skip = 0
+        keyset = False
+        self.last_key = None
+        fields = self.sort_fields()
         if self.table_index is not None:
             index = self.table_index
 
         # If i need only one element
         if myid is not None:
-            query = query.get_all(myid, index=index)
+            query = self.select(index, myid)
             timestamp = True
-        # elif self.sort_index is not None:
-        #     query = query.order_by(index=self.sort_index)
+        elif self.sort_index is not None:
+            if cursor is not None and fields is not None:
+                keyset = True
+                query = query.between(
+                    cursor, r.maxval,
+                    index=self.sort_index, left_bound='open')
+            query = query.order_by(index=self.sort_index)
+
+        if not keyset and current_page > 1 and limit > 0:
+            skip = (current_page - 1) * limit
 
         # Process
-        return self.execute_query(query, limit, timestamp)
+        # (counting the remaining elements would cost as much as skipping)
+        count, data = self.execute_query(
+            query, limit, timestamp, skip=skip,
+            exact_count=False if keyset else None)
+
+        # Where the next page starts
+        if fields is not None and myid is None and len(data) > 0:
+            if keyset or not self.exact_count:
+                more = self.has_more
+            else:
+                more = skip + len(data) < count
+            if more:
+                self.last_key = self.sort_key(data[-1], fields)
+
+        return count, data
 
+    @timed('rdb.insert')
     def insert(self, data, table=None):
         # Prepare the query
         query = self.get_table_query(table)
@@ -285,10 +885,57 @@ class RDBquery(RDBdefaults):
             return rdb_out['generated_keys'].pop()
         return 'Unknown ID'
 
+    def stream_content(self, myid=None, index='id'):
+        """
+        Like get_content, but lazy and without paging:
+        the driver cursor fetches documents from the server in batches.
+        """
+
+        query = self.get_table_query()
+        if self.table_index is not None:
+            index = self.table_index
+        if myid is not None:
+            query = self.select(index, myid)
+        elif self.sort_index is not None:
+            query = query.order_by(index=self.sort_index)
+        # Raw times: they can be serialized as they are
+        return query.run(time_format='raw')
+
+    @timed('rdb.insert_many')
+    def insert_many(self, documents, table=None, batch_size=None,
+                    durability='soft'):
+        """
+        Insert a list of documents with one query for each chunk.
+        Results follow the input order: {'id': key} or {'error': message}
+        """
+        if batch_size is None:
+            batch_size = self.bulk_size
+        query = self.get_table_query(table)
+        results = []
+
+        for start in range(0, len(documents), batch_size):
+            chunk = [self.save_action_info(document)
+                     for document in documents[start:start + batch_size]]
+            # Changes come back in the same order of the inserted objects
+            rdb_out = query.insert(
+                chunk, durability=durability, return_changes='always').run()
+            logger.debug("Bulk insert: %s inserted, %s errors"
+                         % (rdb_out['inserted'], rdb_out['errors']))
+
+            for change in rdb_out.get('changes', []):
+                if 'error' in change:
+                    results.append({'error': change['error']})
+                else:
+                    new_val = change.get('new_val') or {}
+                    results.append({'id': new_val.get('id', 'Unknown ID')})
+
+        return results
+
     def replace(self, data, table=None):
         self.get_table_query(table).replace(
             self.save_action_info(data, action='try_replace')).run()
 
+    @timed('rdb.update')
     def update(self, key, data, table=None):
         # Prepare the query
         self.get_table_query(table).update(
@@ -321,17 +968,64 @@ def schema_and_tables(fileschema):
     fname = os.path.join(JSONS_PATH, fileschema + JSONS_EXT)
     with open(fname) as f:
         template = json.load(f)
-    reference_schema = convert_to_marshal(template)
     label = os.path.splitext(
         os.path.basename(fileschema))[0].lower()
+    # Indexes are not part of the documents
+    indexes = template.pop(INDEXES_KEY, None)
+    if indexes is not None:
+        index_manager.declare(label, indexes)
+    index_manager.declare_fields(label, template)
+    reference_schema = convert_to_marshal(template)
 
     return label, template, reference_schema
 
 
+def load_indexes(models):
+    """ Declare the indexes found inside all models (at startup) """
+    for model in models:
+        fileschema = os.path.splitext(os.path.basename(model))[0]
+        schema_and_tables(fileschema)
+    return index_manager.status()
+
+
 #####################################
 # Base implementation for methods?
 class BaseRethinkResource(ExtendedApiResource, RDBquery):
-    """ The json endpoint in a rethinkdb base class """
+    """
+    The json endpoint in a rethinkdb base class.
+
+    'get' always gives (count, data). Before it, a subclass may answer
+    with a stream or a 304, e.g.:
+
+        out = self.stream_response(key) or self.conditional_response()
+        if out is not None:
+            return out
+        count, data = super().get(key)
+    """
+
+    def stream_response(self, data_key=None):
+        """ The whole result as a stream, if the client asks for it """
+        mimetype = request.accept_mimetypes.best_match(
+            ['application/json'] + STREAM_MIMETYPES)
+        if mimetype not in STREAM_MIMETYPES:
+            return None
+        return output_stream(self.stream_content(data_key), mimetype)
+
+    def conditional_response(self):
+        """
+        Conditional GET: a small query may avoid the real one
+        (without a changefeed, computing the version costs a scan).
+        A 304 response if the client is up to date, otherwise None
+        """
+        if not self.is_conditional():
+            return None
+        self.set_version(self.get_version())
+        if self.version is None:
+            return None
+        etag = self.make_etag()
+        if self.not_modified(etag, self.last_modified):
+            return self.not_modified_response(etag, self.last_modified)
+        return None
 
     def get(self, data_key=None):
         """
@@ -340,9 +1034,26 @@ class BaseRethinkResource(ExtendedApiResource, RDBquery):
         Filter with predefined queries.
         """
 
-# TO FIX: use CURRENTPAGE
-        current_page, limit = self.get_paging()
-        return self.get_content(data_key, limit)
+        # Only the cheap version, if not known already
+        if self.version is None:
+            self.set_version(self.get_version(compute=False))
+
+        current_page, limit, cursor = self.get_paging(with_cursor=True)
+        out = self.get_content(data_key, limit, current_page=current_page,
+                               cursor=cursor)
+        if self.last_key is not None:
+            self.next_cursor = self.encode_cursor(self.last_key)
+        return out
+
+    def set_version(self, version):
+        """
+        The table version gives the ETag.
+        Last-Modified only from the changefeed: deletes are seen too
+        """
+        self.version = version
+        modified = table_versions.modified(self.table)
+        if version is not None and modified > 0:
+            self.last_modified = modified
 
     def check_valid(self, json_data):
         """ Verify if the json data follows the schema """
@@ -358,9 +1069,41 @@ class BaseRethinkResource(ExtendedApiResource, RDBquery):
         # All fine here
         return True
 
+    def get_documents(self):
+        """ One JSON document, a JSON array or NDJSON lines """
+        if request.mimetype in NDJSON_MIMETYPES:
+            try:
+                return parse_ndjson(request.get_data(as_text=True))
+            except ValueError as e:
+                logger.warning("Invalid NDJSON body: %s" % e)
+                raise RESTError("Invalid NDJSON body: %s" % e,
+                                status_code=hcodes.HTTP_BAD_REQUEST)
+        return self.get_input()
+
+    def post_many(self, documents):
+        """ Batch mode: invalid documents are reported, not inserted """
+        results = [None] * len(documents)
+        valid = []
+        positions = []
+        for position, document in enumerate(documents):
+            if self.check_valid(document):
+                valid.append(document)
+                positions.append(position)
+            else:
+                results[position] = {'error': "Not a valid template"}
+
+        if len(valid) > 0:
+            inserted = self.insert_many(valid)
+            for position, result in zip(positions, inserted):
+                results[position] = result
+
+        return results
+
     def post(self):
 
-        json_data = self.get_input()
+        json_data = self.get_documents()
+        if isinstance(json_data, list):
+            return self.post_many(json_data)
         if not self.check_valid(json_data):
             logger.warning("Not a valid template")
             return self.template, hcodes.HTTP_BAD_REQUEST
@@ -386,6 +1129,10 @@ class BaseRethinkResource(ExtendedApiResource, RDBquery):
             logger.warning("Not a valid template")
             return self.template, hcodes.HTTP_BAD_REQUEST
 
+        # Keep the history: versions and Last-Modified rely on it
+        json_data[LOGS_COLUMN] = r.row[LOGS_COLUMN].default([]) \
+            .append(self.action_log('update'))
+
         changes = self.get_table_query().get_all(id, index=index) \
             .update(json_data, return_changes=True).run()
         # Contains all changes applied
@@ -63,6 +63,9 @@ def create_endpoints(custom_epo, security=False, debug=False):
     if security:
         from .resources import checkauth
         custom_epo.many_from_module(checkauth)
+        # Timings of the server, for admins
+        from .resources import monitor
+        custom_epo.many_from_module(monitor)
     else:
         from .resources.checkauth import Verify
         custom_epo.create_many([Verify])
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+JSON encoding of responses.
+
+Encoding is often the main CPU cost of large list endpoints:
+use the fastest library available in the container.
+Types that the standard library refuses (dates, UUIDs, bytes...)
+are converted in the same way whatever the library.
+"""
+
+from __future__ import division, absolute_import
+from . import myself, lic, get_logger
+
+import time
+import uuid
+import base64
+import decimal
+import datetime
+
+# Base library: the one used before any faster alternative
+try:
+    import simplejson as json
+except ImportError:
+    try:
+        import commentjson as json
+    except ImportError:
+        import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+__author__ = myself
+__copyright__ = myself
+__license__ = lic
+
+logger = get_logger(__name__)
+
+
+##############################
+# Types outside of JSON
+def json_default(obj):
+    """ Called by the encoders for objects they do not know """
+    # Note: rethinkdb native times are datetimes with their own tzinfo
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return base64.b64encode(obj).decode('ascii')
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError("Object of type %s is not JSON serializable"
+                    % type(obj).__name__)
+
+
+##############################
+# Backends
+def dumps_orjson(data):
+    return orjson.dumps(
+        data, default=json_default, option=orjson.OPT_NON_STR_KEYS
+    ).decode('utf-8')
+
+
+def dumps_ujson(data):
+    try:
+        return ujson.dumps(data, ensure_ascii=False, default=json_default)
+    except TypeError:
+        # Old versions do not know 'default'
+        return dumps_base(data)
+
+
+def dumps_base(data):
+    return json.dumps(data, default=json_default)
+
+
+BACKENDS = [('base', dumps_base)]
+if ujson is not None:
+    BACKENDS.insert(0, ('ujson', dumps_ujson))
+if orjson is not None:
+    BACKENDS.insert(0, ('orjson', dumps_orjson))
+
+# The fastest one first
+BACKEND_NAME, dumps = BACKENDS[0]
+logger.debug("JSON encoding with '%s'" % BACKEND_NAME)
+
+if orjson is not None:
+    loads = orjson.loads
+else:
+    loads = json.loads
+
+
+def set_backend(name):
+    """ Force a specific library, e.g. to compare outputs """
+    global BACKEND_NAME, dumps
+    for backend_name, function in BACKENDS:
+        if backend_name == name:
+            BACKEND_NAME, dumps = backend_name, function
+            return True
+    return False
+
+
+def benchmark(data, rounds=100):
+    """
+    Seconds to encode 'data' with each available library.
+    'current' is the plain call used before this module existed.
+    """
+    timings = {}
+    candidates = [('current', json.dumps)] + BACKENDS
+    for name, function in candidates:
+        start = time.time()
+        try:
+            for _ in range(rounds):
+                function(data)
+        except TypeError:
+            timings[name] = None
+            continue
+        timings[name] = time.time() - start
+    return timings
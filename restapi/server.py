@@ -9,7 +9,7 @@ from __future__ import division, absolute_import
 from . import myself, lic, get_logger
 
 import os
-from flask import Flask, request, got_request_exception, jsonify
+from flask import Flask, got_request_exception, jsonify
 from .jsonify import make_json_error
 from werkzeug.exceptions import default_exceptions
 from .jsonify import log_exception, RESTError
@@ -168,6 +168,14 @@ def create_app(name=__name__, enable_security=True, debug=False, **kwargs):
     # RETHINKDB
 # // TO FIX, not for every endpoint
     if RDB_AVAILABLE:
+        # Know which tables exist, without asking at every query
+        from .resources.services.rethink import tables_catalog
+        tables_catalog.watch()
+        # Secondary indexes declared in models, built in background
+        from .resources.services.rethink import index_manager, load_indexes
+        load_indexes(MODELS)
+        index_manager.sync_in_background()
+
         @microservice.before_request
         def before_request():
             logger.debug("Hello request RDB")
@@ -180,13 +188,21 @@ def create_app(name=__name__, enable_security=True, debug=False, **kwargs):
             from .resources.services.rethink import try_to_connect
             try_to_connect()
 
+        @microservice.teardown_request
+        def teardown_request(exception):
+            # Connection goes back to the pool for other threads
+            from .resources.services.rethink import release_connection
+            release_connection(exception)
+
     ##############################
-    # Logging responses
-    @microservice.after_request
-    def log_response(response):
-        logger.info("{} {} {}\n{}".format(
-                    request.method, request.url, request.data, response))
-        return response
+    # Logging responses (sampled, written in background)
+    from .accesslog import init_access_log
+    init_access_log(microservice)
+
+    ##############################
+    # Timing requests and backend calls (Server-Timing header)
+    from .timing import init_timing
+    init_timing(microservice)
     # OR
     # http://www.wiredmonk.me/error-handling-and-logging-in-flask-restful.html
     # WRITE TO FILE
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Where does a request spend its time?
+
+Backend calls decorated with 'timed' become spans of the current request:
+they are sent to the client inside the 'Server-Timing' header,
+and aggregated (per endpoint and per backend operation)
+to read percentiles from an admin endpoint.
+"""
+
+from __future__ import division, absolute_import
+from . import myself, lic, get_logger
+
+import time
+import threading
+from functools import wraps
+from collections import deque
+from flask import g, request, has_request_context
+
+__author__ = myself
+__copyright__ = myself
+__license__ = lic
+
+logger = get_logger(__name__)
+
+# Samples kept for each operation: percentiles are on the latest ones
+TIMING_SAMPLES = 1024
+PERCENTILES = [50, 95, 99]
+
+
+class Histogram(object):
+    """ Latest durations of one operation (milliseconds) """
+
+    def __init__(self, size=TIMING_SAMPLES):
+        super(Histogram, self).__init__()
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        values = sorted(self.samples)
+        out = {'count': self.count, 'mean': None}
+        if self.count > 0:
+            out['mean'] = round(self.total / self.count, 3)
+        for percentile in PERCENTILES:
+            key = 'p%s' % percentile
+            out[key] = None
+            if len(values) > 0:
+                position = int(round(percentile / 100 * (len(values) - 1)))
+                out[key] = round(values[position], 3)
+        return out
+
+
+class Timings(object):
+    """ All the histograms, grouped by kind (e.g. endpoint or backend) """
+
+    def __init__(self):
+        super(Timings, self).__init__()
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, kind, name, milliseconds):
+        with self._lock:
+            group = self._histograms.setdefault(kind, {})
+            if name not in group:
+                group[name] = Histogram()
+            group[name].add(milliseconds)
+
+    def summary(self):
+        with self._lock:
+            return dict(
+                (kind, dict((name, histogram.summary())
+                            for name, histogram in group.items()))
+                for kind, group in self._histograms.items())
+
+    def clear(self):
+        with self._lock:
+            self._histograms = {}
+
+
+timings = Timings()
+
+
+##############################
+# Spans
+def add_span(name, milliseconds):
+    timings.record('backend', name, milliseconds)
+    if has_request_context():
+        spans = g.get('timing_spans')
+        if spans is None:
+            spans = g.timing_spans = []
+        spans.append((name, milliseconds))
+
+
+def timed(name):
+    """ Decorate a function or method: every call becomes a span """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add_span(name, (time.time() - start) * 1000)
+        return wrapper
+    return decorator
+
+
+def server_timing(spans, total=None):
+    """ The 'Server-Timing' header: same operations are summed up """
+    durations = {}
+    order = []
+    for name, milliseconds in spans:
+        if name not in durations:
+            order.append(name)
+            durations[name] = 0
+        durations[name] += milliseconds
+    metrics = ['%s;dur=%.2f' % (name, durations[name]) for name in order]
+    if total is not None:
+        metrics.append('total;dur=%.2f' % total)
+    return ', '.join(metrics)
+
+
+def init_timing(app):
+    """ Measure every request of the Flask app """
+
+    @app.before_request
+    def start_timing():
+        g.timing_start = time.time()
+        g.timing_spans = []
+
+    @app.after_request
+    def stop_timing(response):
+        start = g.get('timing_start')
+        if start is None:
+            return response
+        total = (time.time() - start) * 1000
+        endpoint = '%s %s' % (request.method, request.endpoint)
+        timings.record('endpoint', endpoint, total)
+        response.headers['Server-Timing'] = \
+            server_timing(g.get('timing_spans', []), total)
+        return response
+
+    return timings
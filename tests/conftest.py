@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+# Outside gunicorn 'confs.config' parses the command line,
+# which here holds the arguments of pytest
+os.environ.setdefault('SERVER_SOFTWARE', 'gunicorn')
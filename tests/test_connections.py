@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from restapi.resources.services.connections import \
+    ConnectionPool, PoolTimeout
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.open = True
+
+    def is_open(self):
+        return self.open
+
+    def close(self):
+        self.open = False
+
+
+def test_released_connection_is_reused():
+    pool = ConnectionPool(FakeConnection, max_size=2)
+    first = pool.checkout()
+    pool.checkin(first)
+    assert pool.checkout() is first
+    assert pool.stats()['created'] == 1
+
+
+def test_full_pool_times_out():
+    pool = ConnectionPool(FakeConnection, max_size=1, timeout=0.05)
+    pool.checkout()
+    with pytest.raises(PoolTimeout):
+        pool.checkout()
+
+
+def test_closed_connection_is_replaced():
+    pool = ConnectionPool(FakeConnection, max_size=1)
+    first = pool.checkout()
+    pool.checkin(first)
+    first.open = False
+    second = pool.checkout()
+    assert second is not first
+    assert pool.stats()['evicted'] == 1
+
+
+def test_idle_connections_expire():
+    pool = ConnectionPool(FakeConnection, max_size=1, max_idle=-1)
+    first = pool.checkout()
+    pool.checkin(first)
+    assert pool.checkout() is not first
+    assert not first.open
+
+
+def test_failed_factory_frees_the_slot():
+    calls = []
+
+    def factory():
+        calls.append(1)
+        if len(calls) < 2:
+            raise IOError("unreachable")
+        return FakeConnection()
+
+    pool = ConnectionPool(factory, max_size=1, timeout=0.05)
+    with pytest.raises(IOError):
+        pool.checkout()
+    assert pool.checkout() is not None
+    assert pool.stats()['in_use'] == 1
+
+
+def test_unknown_connection_is_refused():
+    pool = ConnectionPool(FakeConnection)
+    assert not pool.checkin(FakeConnection())
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+pytest.importorskip('dateutil')
+pytest.importorskip('timestring')
+from restapi.dates import parse_date, convert_to_ordered_string  # noqa
+
+
+def test_known_formats():
+    assert parse_date('1622-03-11') == (1622, 3, 11)
+    assert parse_date('1622-03-11T00:00:00') == (1622, 3, 11)
+    assert parse_date('11-03-1622') == (1622, 3, 11)
+    assert parse_date(' 03-1622 ') == (1622, 3, None)
+    assert parse_date('1622-03') == (1622, 3, None)
+    assert parse_date('1622') == (1622, None, None)
+    assert parse_date('29-02-1620') == (1620, 2, 29)
+
+
+def test_impossible_dates_are_not_accepted():
+    for text in ['45-03-1622', '31-02-1622', '13-1622']:
+        try:
+            parts = parse_date(text)
+        except ValueError:
+            continue
+        assert parts != (1622, 3, 45) and parts != (1622, 2, 31)
+
+
+def test_ordered_string():
+    date = {'start': '11-03-1622', 'end': '19-04-1622'}
+    assert convert_to_ordered_string(date) == '1622 03-04 11-19'
+    assert convert_to_ordered_string(
+        date, separator=' / ', day_first=True) == '11-19 / 03-04 / 1622'
+
+
+def test_ordered_string_day_first_skips_empty_parts():
+    date = {'start': '1622', 'end': '1622'}
+    assert convert_to_ordered_string(
+        date, separator=' / ', day_first=True) == '1622'
+    date = {'start': '03-1622', 'end': '1622-03'}
+    assert convert_to_ordered_string(
+        date, separator=' / ', day_first=True) == '03 / 1622'
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+from operations.dedup import DigestSet, BloomFilter, new_dedup, digest
+
+
+def test_digest_is_stable_and_small():
+    assert digest('fete') == digest(b'fete')
+    assert digest('fete') != digest('fetes')
+    assert len(digest('fete')) == 8
+
+
+def test_digest_set():
+    seen = DigestSet()
+    assert seen.add('label\0value')
+    assert not seen.add('label\0value')
+    assert 'label\0value' in seen
+    assert 'label\0other' not in seen
+    assert len(seen) == 1
+
+
+def test_bloom_filter_has_no_false_negatives():
+    seen = BloomFilter(capacity=1000, error_rate=0.01)
+    values = ['value %s' % number for number in range(1000)]
+    for value in values:
+        seen.add(value)
+    assert all(value in seen for value in values)
+
+
+def test_bloom_filter_error_rate():
+    seen = BloomFilter(capacity=1000, error_rate=0.01)
+    for number in range(1000):
+        seen.add('value %s' % number)
+    false_positives = sum(
+        'other %s' % number in seen for number in range(10000))
+    # A bit of margin over the expected 1%
+    assert false_positives < 300
+
+
+def test_bloom_filter_add():
+    seen = BloomFilter(capacity=100, error_rate=0.001)
+    assert seen.add('new')
+    assert not seen.add('new')
+    assert len(seen) == 1
+
+
+def test_new_dedup():
+    assert isinstance(new_dedup('set'), DigestSet)
+    assert isinstance(new_dedup('bloom'), BloomFilter)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+pytest.importorskip('lxml')
+from operations.html import tokenize  # noqa: E402
+
+
+def tokens(html_text):
+    return [element['token'] for element in tokenize(html_text)]
+
+
+def test_tags_and_entities_are_not_tokens():
+    assert tokens("<p>L'église de Saint-Jean,&nbsp;1622.</p>") == \
+        ["L'église", 'de', 'Saint', 'Jean', '1622']
+
+
+def test_numbers_keep_their_separators():
+    assert tokens('3.14 et 1,5') == ['3.14', 'et', '1,5']
+
+
+def test_token_details():
+    first, second = tokenize('<b>fete</b> 1622')
+    assert first['type'] == '<ALPHANUM>'
+    assert second['type'] == '<NUM>'
+    assert [first['position'], second['position']] == [0, 1]
+    assert (first['start_offset'], first['end_offset']) == (1, 5)
+
+
+def test_empty_text():
+    assert tokenize('') == []